@@ -0,0 +1,202 @@
+"""
+Multi-process data parallel scaling of ReformerLM training on one machine, with the gloo backend on the cpu.
+
+    python -m benchmarks.distributed --processes 1 2 4 --threads 16 --output distributed.json
+    python -m benchmarks.distributed --processes 1 2 4 --threads 16 --compare distributed.json
+
+The cpu threads are split evenly between the processes, as they would be with one process per socket. Each
+configuration reports the training tokens per second summed over the processes, and the scaling efficiency against
+a single process with all the threads. Gradients are all-reduced explicitly, as in the pretraining trainer, and the
+replicas are checked to still hold identical parameters at the end.
+
+It then checks, on a small model with two processes, the case of processes holding different numbers of micro
+batches. As in the pretraining trainer, the process out of batches keeps stepping with zero gradients, and runs the
+same schedule of collectives as the one still training, here a summed evaluation and a gathered checkpoint state.
+Skip it with --no-uneven_check.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.distributed as dist
+
+from reformer_pytorch import ReformerLM
+from reformer_pytorch.distributed import launch, broadcast_parameters, all_reduce_gradients, all_reduce_sums, all_gather_tensor
+from benchmarks.utils import save_report, load_report, compare_reports
+
+def train_process(rank, world_size, args, threads, result_path):
+    torch.set_num_threads(max(1, threads // world_size))
+    torch.manual_seed(args.seed + rank)
+
+    model = ReformerLM(
+        num_tokens = args.num_tokens,
+        dim = args.dim,
+        depth = args.depth,
+        max_seq_len = args.seq_len,
+        heads = args.heads,
+        bucket_size = args.bucket_size,
+        n_hashes = args.n_hashes,
+        causal = True
+    )
+    optim = torch.optim.Adam(model.parameters(), lr = 1e-4)
+    broadcast_parameters(model)
+
+    data = torch.randint(0, args.num_tokens, (args.batch, args.seq_len + 1))
+    x, labels = data[:, :-1], data[:, 1:]
+
+    def train_step():
+        loss = model(x, labels = labels)
+        loss.backward()
+        all_reduce_gradients(model)
+        optim.step()
+        optim.zero_grad()
+
+    model.train()
+    train_step()
+
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        train_step()
+    dist.barrier()
+    train_time = time.perf_counter() - start
+
+    # the replicas must have taken the same steps
+    checksum = torch.stack([p.detach().double().sum() for p in model.parameters()]).sum().view(1)
+    checksums = [torch.zeros_like(checksum) for _ in range(world_size)]
+    dist.all_gather(checksums, checksum)
+
+    if rank == 0:
+        with open(result_path, 'w') as f:
+            json.dump({
+                'train_time_s': train_time,
+                'in_sync': all(torch.allclose(c, checksum) for c in checksums)
+            }, f)
+
+def run_config(params, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, 'result.json')
+        launch(train_process, params['processes'], args, params['threads'], result_path, master_port = args.port)
+        with open(result_path) as f:
+            result = json.load(f)
+
+    tokens = params['processes'] * args.batch * args.seq_len * args.steps
+    return {
+        'name': 'reformer_lm_distributed',
+        'params': params,
+        'train_tokens_per_s': tokens / result['train_time_s'],
+        'in_sync': result['in_sync']
+    }
+
+def uneven_process(rank, world_size, args, result_path):
+    torch.manual_seed(args.seed + rank)
+
+    model = ReformerLM(num_tokens = 256, dim = 64, depth = 1, max_seq_len = 128, heads = 2, bucket_size = 16, n_hashes = 2, causal = True)
+    optim = torch.optim.Adam(model.parameters(), lr = 1e-4)
+    broadcast_parameters(model)
+
+    # the second process has more micro batches, and the schedule of collectives falls on the steps both
+    # processes train as well as on those only the second one does
+    num_steps = 3 + 4 * rank
+    schedule_steps = 2
+    data = torch.randint(0, 256, (num_steps, 1, 129))
+    global_steps = 0
+
+    def run_schedule():
+        if global_steps % schedule_steps == 0:
+            all_reduce_sums((float(rank), 1.), 'cpu')
+            all_gather_tensor(torch.tensor([global_steps, rank]), 'cpu')
+
+    model.train()
+    for seq in data:
+        loss = model(seq[:, :-1], labels = seq[:, 1:])
+        loss.backward()
+        all_reduce_gradients(model)
+        optim.step()
+        optim.zero_grad()
+        global_steps += 1
+        run_schedule()
+
+    while all_reduce_gradients(model, active = False) > 0:
+        optim.step()
+        optim.zero_grad()
+        global_steps += 1
+        run_schedule()
+
+    checksum = torch.stack([p.detach().double().sum() for p in model.parameters()]).sum().view(1)
+    checksums = all_gather_tensor(checksum, 'cpu')
+    steps = all_gather_tensor(torch.tensor([global_steps]), 'cpu')
+
+    if rank == 0:
+        with open(result_path, 'w') as f:
+            json.dump({
+                'in_sync': all(torch.allclose(c, checksum) for c in checksums),
+                'same_steps': len(set(int(s) for s in steps)) == 1
+            }, f)
+
+def uneven_check(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, 'result.json')
+        launch(uneven_process, 2, args, result_path, master_port = args.port)
+        with open(result_path) as f:
+            result = json.load(f)
+
+    print('uneven micro batches', result)
+    return result['in_sync'] and result['same_steps']
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark multi-process data parallel ReformerLM training on the cpu')
+    parser.add_argument('--processes', nargs = '+', type = int, default = [1, 2])
+    parser.add_argument('--threads', type = int, default = torch.get_num_threads(), help = 'cpu threads shared by the processes')
+    parser.add_argument('--depth', type = int, default = 6)
+    parser.add_argument('--dim', type = int, default = 512)
+    parser.add_argument('--num_tokens', type = int, default = 256)
+    parser.add_argument('--seq_len', type = int, default = 1024)
+    parser.add_argument('--batch', type = int, default = 1, help = 'batch size of each process')
+    parser.add_argument('--heads', type = int, default = 8)
+    parser.add_argument('--bucket_size', type = int, default = 64)
+    parser.add_argument('--n_hashes', type = int, default = 4)
+    parser.add_argument('--steps', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--port', type = int, default = 29500)
+    parser.add_argument('--uneven_check', action = 'store_true', default = True, help = 'check two processes with different numbers of micro batches')
+    parser.add_argument('--no-uneven_check', dest = 'uneven_check', action = 'store_false')
+    parser.add_argument('--output', default = None, help = 'path to write the json report to')
+    parser.add_argument('--compare', default = None, help = 'path of a baseline json report to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.1, help = 'slowdown ratio over the baseline counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for processes in args.processes:
+        params = {'processes': processes, 'threads': args.threads}
+        result = run_config(params, args)
+        results.append(result)
+
+    # scaling efficiency against one process, when it was measured
+    single = next((r['train_tokens_per_s'] for r in results if r['params']['processes'] == 1), None)
+    for result in results:
+        if single is not None:
+            result['scaling_efficiency'] = result['train_tokens_per_s'] / single
+        print(result['params'], {k: v for k, v in result.items() if k not in ('name', 'params')})
+
+    if args.output is not None:
+        save_report(args.output, results)
+
+    failed = any(not r['in_sync'] for r in results)
+
+    if args.uneven_check:
+        failed |= not uneven_check(args)
+
+    if args.compare is not None:
+        metrics = [('train_tokens_per_s', True), ('scaling_efficiency', True)]
+        failed |= compare_reports(results, load_report(args.compare), metrics, args.threshold) > 0
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
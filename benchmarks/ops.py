@@ -0,0 +1,177 @@
+"""
+Operator level benchmarks for the attention and hashing hot paths.
+
+    python -m benchmarks.ops --output ops.json
+    python -m benchmarks.ops --compare ops.json
+    python -m benchmarks.ops --large --output ops_large.json
+
+The default sweep fits in a few hundred megabytes. --large adds sequence length 4096 and 8 hash rounds, where the
+chunked_sum input alone takes about 2GB.
+
+Each case reports median forward and backward wall time in milliseconds, and the peak memory of a
+forward and backward pass in megabytes (resident set on cpu, allocated memory on cuda).
+"""
+
+import sys
+import argparse
+from itertools import product
+
+import torch
+
+from reformer_pytorch.reformer_pytorch import LSHAttention, FullQKAttention, LSHSelfAttention, sort_key_val, batched_index_select, chunked_sum
+from benchmarks.utils import time_fn, measure_peak_memory, save_report, load_report, compare_reports
+
+# each op takes the sweep parameters it uses, and returns a function running the forward pass
+# along with the tensors the backward pass should differentiate
+
+def lsh_attention(batch, seqlen, dim_head, heads, bucket_size, n_hashes, causal, attend_across_buckets, input_mask, device):
+    attn = LSHAttention(bucket_size = bucket_size, n_hashes = n_hashes, causal = causal, attend_across_buckets = attend_across_buckets).to(device)
+    qk = torch.randn(batch * heads, seqlen, dim_head, device = device, requires_grad = True)
+    v = torch.randn(batch * heads, seqlen, dim_head, device = device, requires_grad = True)
+    # pads the last eighth of the sequence
+    mask = (torch.arange(seqlen, device = device) < seqlen - seqlen // 8).expand(batch * heads, -1) if input_mask else None
+    return lambda: attn(qk, v, input_mask = mask)[0], (qk, v)
+
+def full_qk_attention(batch, seqlen, dim_head, heads, causal, device):
+    attn = FullQKAttention(causal = causal).to(device)
+    qk = torch.randn(batch * heads, seqlen, dim_head, device = device, requires_grad = True)
+    v = torch.randn(batch * heads, seqlen, dim_head, device = device, requires_grad = True)
+    return lambda: attn(qk, v)[0], (qk, v)
+
+def lsh_self_attention(batch, seqlen, dim_head, heads, bucket_size, n_hashes, attn_chunks, causal, attend_across_buckets, device):
+    attn = LSHSelfAttention(dim_head * heads, heads = heads, bucket_size = bucket_size, n_hashes = n_hashes, attn_chunks = attn_chunks, causal = causal, attend_across_buckets = attend_across_buckets).to(device)
+    x = torch.randn(batch, seqlen, dim_head * heads, device = device, requires_grad = True)
+    return lambda: attn(x), (x,)
+
+def hash_vectors(batch, seqlen, dim_head, heads, bucket_size, n_hashes, device):
+    attn = LSHAttention(bucket_size = bucket_size, n_hashes = n_hashes).to(device)
+    qk = torch.randn(batch * heads, seqlen, dim_head, device = device)
+    return lambda: attn.hash_vectors(seqlen // bucket_size, qk), ()
+
+def sort_key_val_op(batch, seqlen, heads, n_hashes, device):
+    keys = torch.randint(0, seqlen, (batch * heads, n_hashes * seqlen), device = device)
+    ticker = torch.arange(n_hashes * seqlen, device = device).unsqueeze(0)
+    return lambda: sort_key_val(keys, ticker, dim = -1)[1], ()
+
+def batched_index_select_op(batch, seqlen, dim_head, heads, n_hashes, device):
+    values = torch.randn(batch * heads, seqlen, dim_head, device = device, requires_grad = True)
+    indices = torch.randint(0, seqlen, (batch * heads, n_hashes * seqlen), device = device)
+    return lambda: batched_index_select(values, indices), (values,)
+
+def chunked_sum_op(batch, seqlen, heads, bucket_size, n_hashes, device):
+    # shaped like the duplicate attention counts, the largest tensor it is used on
+    counts = torch.rand(batch * heads, n_hashes * seqlen // bucket_size, bucket_size, bucket_size * 2, n_hashes * 2, device = device) < 0.1
+    return lambda: chunked_sum(counts, chunks = n_hashes * batch), ()
+
+OPS = {
+    'lsh_attention': lsh_attention,
+    'full_qk_attention': full_qk_attention,
+    'lsh_self_attention': lsh_self_attention,
+    'hash_vectors': hash_vectors,
+    'sort_key_val': sort_key_val_op,
+    'batched_index_select': batched_index_select_op,
+    'chunked_sum': chunked_sum_op
+}
+
+SWEEP_PARAMS = ('batch', 'seqlen', 'dim_head', 'heads', 'bucket_size', 'n_hashes', 'attn_chunks', 'causal', 'attend_across_buckets', 'input_mask')
+
+def op_params(op):
+    code = op.__code__
+    return [name for name in code.co_varnames[:code.co_argcount] if name != 'device']
+
+def cases(ops, sweep):
+    seen = set()
+    grid = [dict(zip(SWEEP_PARAMS, values)) for values in product(*[sweep[name] for name in SWEEP_PARAMS])]
+
+    for name in ops:
+        op = OPS[name]
+        for point in grid:
+            # only sweep the parameters an op uses, so ops are not rerun for parameters they ignore
+            params = {k: point[k] for k in op_params(op)}
+            if 'attn_chunks' in params and params['attn_chunks'] > params['heads']:
+                continue
+
+            key = (name, tuple(sorted(params.items())))
+            if key in seen:
+                continue
+
+            seen.add(key)
+            yield name, params
+
+def run_case(name, params, device, warmup, repeats):
+    forward, inputs = OPS[name](device = device, **params)
+
+    def forward_backward():
+        out = forward()
+        if len(inputs) > 0:
+            out.float().sum().backward()
+            for t in inputs:
+                t.grad = None
+
+    forward_time = time_fn(forward, device, warmup, repeats)
+    result = {'name': name, 'params': params, 'forward_ms': forward_time * 1e3, 'backward_ms': None}
+
+    if len(inputs) > 0:
+        total_time = time_fn(forward_backward, device, warmup, repeats)
+        result['backward_ms'] = max(total_time - forward_time, 0.) * 1e3
+
+    result['peak_mem_mb'] = measure_peak_memory(forward_backward, device)
+    return result
+
+def default_sizes(sizes, small, large, use_large):
+    if sizes is not None:
+        return sizes
+    return large if use_large else small
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the Reformer attention and hashing operators')
+    parser.add_argument('--ops', nargs = '+', default = list(OPS.keys()), choices = list(OPS.keys()))
+    parser.add_argument('--batch', nargs = '+', type = int, default = [1])
+    parser.add_argument('--seqlen', nargs = '+', type = int, default = None, help = 'defaults to 1024, and 1024 4096 with --large')
+    parser.add_argument('--dim_head', nargs = '+', type = int, default = [64])
+    parser.add_argument('--heads', nargs = '+', type = int, default = [8])
+    parser.add_argument('--bucket_size', nargs = '+', type = int, default = [64])
+    parser.add_argument('--n_hashes', nargs = '+', type = int, default = None, help = 'defaults to 1 4, and 1 4 8 with --large')
+    parser.add_argument('--attn_chunks', nargs = '+', type = int, default = [1, 8])
+    parser.add_argument('--causal', nargs = '+', type = int, default = [0, 1], choices = [0, 1])
+    parser.add_argument('--attend_across_buckets', nargs = '+', type = int, default = [1], choices = [0, 1])
+    parser.add_argument('--input_mask', nargs = '+', type = int, default = [0], choices = [0, 1])
+    parser.add_argument('--large', action = 'store_true', help = 'sweep the large sizes, which need several gigabytes of memory')
+    parser.add_argument('--device', default = 'cpu')
+    parser.add_argument('--threads', type = int, default = None)
+    parser.add_argument('--warmup', type = int, default = 1)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = None, help = 'path to write the json report to')
+    parser.add_argument('--compare', default = None, help = 'path of a baseline json report to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.1, help = 'slowdown ratio over the baseline counted as a regression')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    args.seqlen = default_sizes(args.seqlen, [1024], [1024, 4096], args.large)
+    args.n_hashes = default_sizes(args.n_hashes, [1, 4], [1, 4, 8], args.large)
+
+    torch.manual_seed(args.seed)
+    sweep = {name: getattr(args, name) for name in SWEEP_PARAMS}
+    sweep['causal'] = [bool(c) for c in sweep['causal']]
+    sweep['attend_across_buckets'] = [bool(c) for c in sweep['attend_across_buckets']]
+    sweep['input_mask'] = [bool(c) for c in sweep['input_mask']]
+
+    results = []
+    for name, params in cases(args.ops, sweep):
+        result = run_case(name, params, args.device, args.warmup, args.repeats)
+        results.append(result)
+        print(name, params, {k: v for k, v in result.items() if k.endswith(('_ms', '_mb'))})
+
+    if args.output is not None:
+        save_report(args.output, results, args.device)
+
+    if args.compare is not None:
+        metrics = [('forward_ms', False), ('backward_ms', False), ('peak_mem_mb', False)]
+        regressions = compare_reports(results, load_report(args.compare), metrics, args.threshold)
+        sys.exit(1 if regressions > 0 else 0)
+
+if __name__ == '__main__':
+    main()
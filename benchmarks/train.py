@@ -0,0 +1,141 @@
+"""
+End to end training and inference throughput of ReformerLM on synthetic tokens.
+
+    python -m benchmarks.train --depth 6 12 --threads 4 8 --output train.json
+    python -m benchmarks.train --depth 6 12 --threads 4 8 --compare train.json
+
+Each configuration reports training and inference tokens per second, the time from constructing the
+model to the end of the first training step, and the peak resident set size in megabytes.
+"""
+
+import gc
+import sys
+import time
+import argparse
+from itertools import product
+
+import torch
+
+from reformer_pytorch import ReformerLM
+from benchmarks.utils import synchronize, reset_peak_memory, peak_memory, save_report, load_report, compare_reports
+
+SWEEP_PARAMS = ('depth', 'dim', 'ff_chunks', 'weight_tie', 'twin_attention', 'use_full_attn', 'attend_across_buckets', 'threads')
+
+def run_config(params, args):
+    device = args.device
+    torch.set_num_threads(params['threads'])
+    torch.manual_seed(args.seed)
+
+    # release the previous configuration's model before resetting the high water mark
+    gc.collect()
+    reset_peak_memory(device)
+
+    tokens_per_step = args.batch * args.seq_len
+    data = torch.randint(0, args.num_tokens, (args.batch, args.seq_len + 1), device = device)
+    x, labels = data[:, :-1], data[:, 1:]
+
+    def train_step():
+        loss = model(x, labels = labels)
+        loss.backward()
+        optim.step()
+        optim.zero_grad()
+
+    start = time.perf_counter()
+
+    model = ReformerLM(
+        num_tokens = args.num_tokens,
+        dim = params['dim'],
+        depth = params['depth'],
+        max_seq_len = args.seq_len,
+        heads = args.heads,
+        bucket_size = args.bucket_size,
+        n_hashes = args.n_hashes,
+        ff_chunks = params['ff_chunks'],
+        weight_tie = params['weight_tie'],
+        twin_attention = params['twin_attention'],
+        use_full_attn = params['use_full_attn'],
+        lsh_attend_across_buckets = params['attend_across_buckets'],
+        causal = args.causal
+    ).to(device)
+
+    optim = torch.optim.Adam(model.parameters(), lr = 1e-4)
+
+    model.train()
+    train_step()
+    synchronize(device)
+    first_step = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        train_step()
+    synchronize(device)
+    train_time = time.perf_counter() - start
+
+    model.eval()
+    with torch.no_grad():
+        model(x)
+        synchronize(device)
+
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            model(x)
+        synchronize(device)
+        inference_time = time.perf_counter() - start
+
+    return {
+        'name': 'reformer_lm',
+        'params': params,
+        'time_to_first_step_s': first_step,
+        'train_tokens_per_s': tokens_per_step * args.steps / train_time,
+        'inference_tokens_per_s': tokens_per_step * args.steps / inference_time,
+        'peak_rss_mb': peak_memory(device)
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark end to end ReformerLM training and inference throughput')
+    parser.add_argument('--depth', nargs = '+', type = int, default = [6])
+    parser.add_argument('--dim', nargs = '+', type = int, default = [512])
+    parser.add_argument('--ff_chunks', nargs = '+', type = int, default = [1, 10])
+    parser.add_argument('--weight_tie', nargs = '+', type = int, default = [0], choices = [0, 1])
+    parser.add_argument('--twin_attention', nargs = '+', type = int, default = [0], choices = [0, 1])
+    parser.add_argument('--use_full_attn', nargs = '+', type = int, default = [0, 1], choices = [0, 1])
+    parser.add_argument('--attend_across_buckets', nargs = '+', type = int, default = [1], choices = [0, 1])
+    parser.add_argument('--threads', nargs = '+', type = int, default = [torch.get_num_threads()])
+    parser.add_argument('--num_tokens', type = int, default = 256)
+    parser.add_argument('--seq_len', type = int, default = 1024)
+    parser.add_argument('--batch', type = int, default = 1)
+    parser.add_argument('--heads', type = int, default = 8)
+    parser.add_argument('--bucket_size', type = int, default = 64)
+    parser.add_argument('--n_hashes', type = int, default = 4)
+    parser.add_argument('--causal', type = int, default = 1, choices = [0, 1])
+    parser.add_argument('--steps', type = int, default = 5)
+    parser.add_argument('--device', default = 'cpu')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = None, help = 'path to write the json report to')
+    parser.add_argument('--compare', default = None, help = 'path of a baseline json report to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.1, help = 'slowdown ratio over the baseline counted as a regression')
+    args = parser.parse_args(argv)
+    args.causal = bool(args.causal)
+
+    bool_params = ('weight_tie', 'twin_attention', 'use_full_attn', 'attend_across_buckets')
+    sweep = [getattr(args, name) for name in SWEEP_PARAMS]
+
+    results = []
+    for values in product(*sweep):
+        params = dict(zip(SWEEP_PARAMS, values))
+        params.update({name: bool(params[name]) for name in bool_params})
+
+        result = run_config(params, args)
+        results.append(result)
+        print(params, {k: v for k, v in result.items() if k not in ('name', 'params')})
+
+    if args.output is not None:
+        save_report(args.output, results, args.device)
+
+    if args.compare is not None:
+        metrics = [('time_to_first_step_s', False), ('train_tokens_per_s', True), ('inference_tokens_per_s', True), ('peak_rss_mb', False)]
+        regressions = compare_reports(results, load_report(args.compare), metrics, args.threshold)
+        sys.exit(1 if regressions > 0 else 0)
+
+if __name__ == '__main__':
+    main()
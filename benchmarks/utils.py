@@ -0,0 +1,127 @@
+import sys
+import json
+import time
+import platform
+import resource
+import statistics
+import torch
+
+# timing
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def time_fn(fn, device = 'cpu', warmup = 1, repeats = 5):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+# memory, in megabytes
+
+def read_proc_status(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss():
+    return read_proc_status('VmRSS')
+
+def reset_peak_memory(device = 'cpu'):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_max_memory_allocated(device)
+
+    # writing 5 to clear_refs resets the resident set high water mark on linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_memory(device = 'cpu'):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+    peak = read_proc_status('VmHWM')
+    if peak is not None:
+        return peak
+
+    # ru_maxrss is never reset, and is in kilobytes on linux but bytes on mac
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 1024
+
+def measure_peak_memory(fn, device = 'cpu'):
+    before = 0. if torch.device(device).type == 'cuda' else (current_rss() or 0.)
+    reset_peak_memory(device)
+    fn()
+    synchronize(device)
+    return max(peak_memory(device) - before, 0.)
+
+# reports
+
+def environment(device = 'cpu'):
+    return {
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'threads': torch.get_num_threads(),
+        'device': str(device)
+    }
+
+def result_key(result):
+    return (result['name'], tuple(sorted(result['params'].items())))
+
+def save_report(path, results, device = 'cpu'):
+    report = {'environment': environment(device), 'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare_reports(results, baseline, metrics, threshold = 1.1):
+    """
+    Prints the ratio of each metric against a baseline report, for cases present in both.
+    Metrics are (name, higher_is_better) pairs.
+    Returns the number of regressions, cases that got worse by more than the threshold ratio.
+    """
+    baseline_results = {result_key(r): r for r in baseline['results']}
+    regressions = 0
+
+    for result in results:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+
+        params = ' '.join(f'{k}={v}' for k, v in sorted(result['params'].items()))
+        for metric, higher_is_better in metrics:
+            new_value, old_value = result.get(metric), base.get(metric)
+            if not new_value or not old_value:
+                continue
+
+            ratio = new_value / old_value
+            worse = (1 / ratio) if higher_is_better else ratio
+            flag = ''
+            if worse > threshold:
+                regressions += 1
+                flag = ' REGRESSION'
+
+            print(f'{result["name"]} {params} | {metric}: {old_value:.3f} -> {new_value:.3f} ({ratio:.2f}x){flag}')
+
+    return regressions
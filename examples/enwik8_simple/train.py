@@ -1,13 +1,10 @@
 from reformer_pytorch import ReformerLM
+from reformer_pytorch.data import MemmapByteDataset, Prefetcher, extract
 
-import random
 import tqdm
-import gzip
-import numpy as np
 import torch
 import torch.optim as optim
-from torch.nn import functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader
 
 # constants
 
@@ -19,6 +16,9 @@ VALIDATE_EVERY  = 100
 GENERATE_EVERY  = 500
 GENERATE_LENGTH = 512
 SEQ_LEN = 4096
+NUM_WORKERS = 2
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 # helpers
 
@@ -27,25 +27,6 @@ def cycle(loader):
         for data in loader:
             yield data
 
-def get_top_p(logits, top_p=0.9):
-    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-    sorted_indices_to_remove = cumulative_probs > top_p
-    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-    sorted_indices_to_remove[..., 0] = 0
-
-    indices_to_remove = sorted_indices[sorted_indices_to_remove]
-    logits[indices_to_remove] = float('-inf')
-    return logits
-
-def sample_next_token(logits, top_p=0.9, temperature = 1.0):
-    logits = logits[0, -1, :] / temperature
-    filtered_logits = get_top_p(logits, top_p=top_p)
-
-    probs = F.softmax(filtered_logits, dim=-1)
-    return torch.multinomial(probs, 1)
-
 def decode_token(token):
     return str(chr(max(32, token)))
 
@@ -69,33 +50,19 @@ model = ReformerLM(
     use_full_attn = False # set this to true for comparison with full attention
 )
 
-model.cuda()
-
-# prepare enwik8 data
-
-with gzip.open('./data/enwik8.gz') as file:
-    X = np.fromstring(file.read(int(95e6)), dtype=np.uint8)
-    trX, vaX = np.split(X, [int(90e6)])
-    data_train, data_val = torch.from_numpy(trX), torch.from_numpy(vaX)
+model.to(DEVICE)
 
-class TextSamplerDataset(Dataset):
-    def __init__(self, data, seq_len):
-        super().__init__()
-        self.data = data
-        self.seq_len = seq_len
+# prepare enwik8 data, memory mapped and cropped a batch at a time in the loader workers,
+# then moved to the device ahead of time on a background thread
 
-    def __getitem__(self, index):
-        rand_start = torch.randint(0, self.data.size(0) - self.seq_len - 1, (1,))
-        full_seq = self.data[rand_start: rand_start + self.seq_len + 1].long()
-        return full_seq[0:-1].cuda(), full_seq[1:].cuda()
+PIN_MEMORY = DEVICE == 'cuda'
 
-    def __len__(self):
-        return self.data.size(0) // self.seq_len
+extract('./data/enwik8.gz', './data/enwik8')
 
-train_dataset = TextSamplerDataset(data_train, SEQ_LEN)
-val_dataset   = TextSamplerDataset(data_val, SEQ_LEN)
-train_loader  = cycle(DataLoader(train_dataset, batch_size = BATCH_SIZE))
-val_loader    = cycle(DataLoader(val_dataset, batch_size = BATCH_SIZE))
+train_dataset = MemmapByteDataset('./data/enwik8', SEQ_LEN, BATCH_SIZE, start = 0, end = int(90e6), pin_memory = PIN_MEMORY)
+val_dataset   = MemmapByteDataset('./data/enwik8', SEQ_LEN, BATCH_SIZE, start = int(90e6), end = int(95e6), pin_memory = PIN_MEMORY)
+train_loader  = cycle(Prefetcher(DataLoader(train_dataset, batch_size = None, num_workers = NUM_WORKERS, pin_memory = PIN_MEMORY), DEVICE))
+val_loader    = cycle(Prefetcher(DataLoader(val_dataset, batch_size = None, num_workers = NUM_WORKERS, pin_memory = PIN_MEMORY), DEVICE))
 
 # optimizer
 
@@ -105,8 +72,7 @@ optim = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
 
 def get_batch_loss(model, data):
     x, y = data
-    pred = model(x)
-    return F.cross_entropy(pred.transpose(1, 2), y, reduction='mean')
+    return model(x, labels = y)
 
 for i in tqdm.tqdm(range(NUM_BATCHES), mininterval=10., desc='training'):
     model.train()
@@ -129,15 +95,14 @@ for i in tqdm.tqdm(range(NUM_BATCHES), mininterval=10., desc='training'):
     if i % GENERATE_EVERY == 0:
         model.eval()
         with torch.no_grad():
-            inp, _ = random.choice(val_dataset)
+            inp = val_dataset.sample(1)[0][0].to(DEVICE)
             output_str = ''
             prime = decode_tokens(inp)
 
             print(f'%s \n\n %s', (prime, '*' * 100))
 
             for _ in tqdm.tqdm(range(GENERATE_LENGTH), desc='generating'):
-                logits = model(inp[None, :])
-                next_token = sample_next_token(logits)
+                next_token = model.sample_next(inp[None, :], top_p = 0.9)
                 output_str += decode_token(next_token)
                 inp = torch.cat((inp[1:], next_token), dim=0)
 
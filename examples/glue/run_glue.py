@@ -16,7 +16,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from reformer_pytorch import Reformer, ReformerLM
+from reformer_pytorch import Reformer, ReformerLM, Prefetcher
 
 from transformers import BertTokenizer, AdamW, get_linear_schedule_with_warmup
 from transformers.data.metrics import glue_compute_metrics as compute_metrics
@@ -152,7 +152,8 @@ class TrainerGLUE(object):
         self.set_seed()
 
         for _ in train_iterator:
-            epoch_iterator = tqdm(train_dataloader, desc='Iteration', disable=False)
+            # batches are moved to the device on a background thread, ahead of the step using them
+            epoch_iterator = tqdm(Prefetcher(train_dataloader, self.device), desc='Iteration', disable=False)
 
             for step, batch in enumerate(epoch_iterator):
 
@@ -162,7 +163,6 @@ class TrainerGLUE(object):
                     continue
 
                 self.model.train()
-                batch = tuple(t.to(self.device) for t in batch)
                 input_ids = batch[0]
                 attention_mask = batch[1]
                 token_type_ids = batch[2]
@@ -260,9 +260,8 @@ class TrainerGLUE(object):
             preds = None
             out_label_ids = None
 
-            for batch in tqdm(eval_dataloader, desc='Evaluating'):
+            for batch in tqdm(Prefetcher(eval_dataloader, self.device), desc='Evaluating'):
                 self.model.eval()
-                batch = tuple(t.to(self.device) for t in batch)
 
                 with torch.no_grad():
                     input_ids = batch[0]
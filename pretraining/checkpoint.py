@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import shutil
+import logging
+from queue import Queue
+from threading import Thread
+from datetime import datetime
+
+import torch
+from reformer_pytorch.data import map_tensors
+
+CHECKPOINT_DIR = re.compile(r'^step_(\d+)$')
+
+
+def snapshot(state):
+    """ Copies every tensor of a (nested) state dict to host memory, so training can go on while it is written. """
+    return map_tensors(lambda t: t.detach().to('cpu', copy=True), state)
+
+
+def append_metrics(path, step, **metrics):
+    """ Appends one json line of metrics, instead of rewriting the whole log. """
+    record = {'step': step, 'time': time.time(), **metrics}
+    with open(path, 'a') as metrics_file:
+        metrics_file.write(json.dumps(record) + '\n')
+
+
+def tensor_bytes(value):
+    sizes = []
+    map_tensors(lambda t: sizes.append(t.numel() * t.element_size()), value)
+    return sum(sizes)
+
+
+def shard_state(state, shard_bytes):
+    """
+    Splits the items of a state dict into shards of about shard_bytes bytes of tensors each.
+    :return: list of dicts, at least one.
+    """
+    shards, shard, size = [], {}, 0
+    for key, value in state.items():
+        value_bytes = tensor_bytes(value)
+        if len(shard) > 0 and size + value_bytes > shard_bytes:
+            shards.append(shard)
+            shard, size = {}, 0
+        shard[key] = value
+        size += value_bytes
+
+    shards.append(shard)
+    return shards
+
+
+class CheckpointManager(object):
+
+    def __init__(self, ckpt_dir, keep_last=3, shard_bytes=512 * 2 ** 20):
+        """
+        Saves checkpoints on a background thread, as directories of sharded state: step_<step>/model_<shard>.pt,
+        step_<step>/optimizer_<shard>.pt and step_<step>/index.pt holding the optimizer param groups and the trainer
+        state. State is first copied to host memory, so training only waits for that copy. A checkpoint directory is
+        written under a temporary name and renamed once complete, so an interrupted save never shadows the last one.
+        :param ckpt_dir: directory to write the checkpoints to.
+        :param keep_last: number of most recent checkpoints to keep.
+        :param shard_bytes: approximate size of each shard.
+        """
+        os.makedirs(ckpt_dir, exist_ok=True)
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.shard_bytes = shard_bytes
+
+        # at most one snapshot waits to be written, bounding the host memory taken by checkpoints
+        self.queue = Queue(maxsize=1)
+        self.error = None
+        self.thread = Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def checkpoints(self):
+        """ Returns the steps of the complete checkpoints, oldest first. """
+        steps = [CHECKPOINT_DIR.match(name) for name in os.listdir(self.ckpt_dir)]
+        return sorted(int(match.group(1)) for match in steps if match is not None)
+
+    def path(self, step):
+        return os.path.join(self.ckpt_dir, f'step_{step:08d}')
+
+    def save(self, step, model, optimizer, trainer_state):
+        """
+        Snapshots model, optimizer and trainer state to host memory, and queues them to be written.
+        :param step: optimizer step the checkpoint is taken at.
+        :param trainer_state: dict of step counters, dataloader position and such, to be restored on resume.
+        """
+        self.raise_error()
+        optimizer_state = optimizer.state_dict()
+        state = {
+            'model': snapshot(model.state_dict()),
+            'optimizer': snapshot(optimizer_state['state']),
+            'param_groups': optimizer_state['param_groups'],
+            'trainer': snapshot(trainer_state)
+        }
+        self.queue.put((step, state))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+                logging.error(f'{datetime.now()} | Failed to write checkpoint | {e}')
+            finally:
+                self.queue.task_done()
+
+    def write(self, step, state):
+        start = time.time()
+        path = self.path(step)
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        model_shards = shard_state(state['model'], self.shard_bytes)
+        optimizer_shards = shard_state(state['optimizer'], self.shard_bytes)
+
+        for ind, shard in enumerate(model_shards):
+            torch.save(shard, os.path.join(tmp_path, f'model_{ind:05d}.pt'))
+        for ind, shard in enumerate(optimizer_shards):
+            torch.save(shard, os.path.join(tmp_path, f'optimizer_{ind:05d}.pt'))
+
+        torch.save({
+            'model_shards': len(model_shards),
+            'optimizer_shards': len(optimizer_shards),
+            'param_groups': state['param_groups'],
+            'trainer': state['trainer']
+        }, os.path.join(tmp_path, 'index.pt'))
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+        for old_step in self.checkpoints()[:-self.keep_last]:
+            shutil.rmtree(self.path(old_step), ignore_errors=True)
+
+        logging.info(f'{datetime.now()} | Saved checkpoint to: {path} | {time.time() - start:.1f}s')
+
+    def load(self, step=None, map_location='cpu'):
+        """
+        Loads a checkpoint, the latest one by default.
+        :return: model state dict, optimizer state dict and trainer state, or None if there is no checkpoint.
+        """
+        steps = self.checkpoints()
+        if step is None and len(steps) == 0:
+            return None
+
+        path = self.path(step if step is not None else steps[-1])
+        index = torch.load(os.path.join(path, 'index.pt'), map_location=map_location)
+
+        def merge(prefix, num_shards):
+            state = {}
+            for ind in range(num_shards):
+                state.update(torch.load(os.path.join(path, f'{prefix}_{ind:05d}.pt'), map_location=map_location))
+            return state
+
+        model_state = merge('model', index['model_shards'])
+        optimizer_state = {'state': merge('optimizer', index['optimizer_shards']), 'param_groups': index['param_groups']}
+        return model_state, optimizer_state, index['trainer']
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        """ Blocks until every queued checkpoint is written. """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,235 @@
+from itertools import islice
+
+import torch
+from torch.utils.data import Sampler
+
+
+def padded_length(length, multiple=None, max_len=None):
+    """
+    Rounds a length up to a multiple, capped at max_len (which should itself be a multiple).
+    LSH attention needs sequence lengths to be a multiple of twice the bucket_size, for an even number of buckets.
+    """
+    if multiple is not None:
+        length = -(-length // multiple) * multiple
+    return min(length, max_len) if max_len is not None else length
+
+
+def token_balanced_batches(lengths, max_tokens, pad_multiple=None, max_len=None):
+    """
+    Groups indices of examples of similar length, so the padded size of each batch stays within max_tokens.
+    :param lengths: number of tokens of each example.
+    :param max_tokens: most tokens, padding included, in a batch. A longer example still gets a batch of its own.
+    :return: list of batches of indices into lengths.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches, batch = [], []
+
+    for ind in order:
+        # examples are visited by increasing length, so the padded length of a batch is that of its last example
+        length = padded_length(lengths[ind], pad_multiple, max_len)
+        if len(batch) > 0 and length * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(ind)
+
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class LengthBucketBatchSampler(Sampler):
+
+    def __init__(self, lengths, max_tokens, pad_multiple=None, max_len=None, shuffle=True, pool_size=65536,
+                 num_replicas=1, rank=0, seed=0, even_shards=True):
+        """
+        Batch sampler grouping examples of similar length into batches balanced by token count rather than examples.
+        :param lengths: number of tokens of each example in the dataset.
+        :param max_tokens: most tokens, padding included, in a batch.
+        :param pad_multiple: length batches are padded up to a multiple of, see padded_length.
+        :param max_len: longest padded length.
+        :param shuffle: (bool) shuffle the examples before grouping, and the order of the batches.
+        :param pool_size: number of shuffled examples sorted by length together, keeping batches random across epochs.
+        :param num_replicas: number of distributed processes, each gets the same number of batches.
+        :param rank: rank of this process among them.
+        :param seed: seed of the shuffling, shared by all processes and offset by the epoch (see set_epoch).
+        :param even_shards: (bool) drop the batches left over once they are split evenly between the processes, as
+                            training steps them in lockstep. Evaluation keeps every batch.
+        """
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.pad_multiple = pad_multiple
+        self.max_len = max_len
+        self.shuffle = shuffle
+        self.pool_size = pool_size if shuffle else len(lengths)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.even_shards = even_shards
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist() if self.shuffle else list(range(len(self.lengths)))
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start:start + self.pool_size]
+            pool_lengths = [self.lengths[ind] for ind in pool]
+            for batch in token_balanced_batches(pool_lengths, self.max_tokens, self.pad_multiple, self.max_len):
+                batches.append([pool[ind] for ind in batch])
+
+        if self.shuffle:
+            batches = [batches[ind] for ind in torch.randperm(len(batches), generator=generator).tolist()]
+
+        # every process draws the same batches from the same seed, and takes its share of them
+        num_batches = len(batches) // self.num_replicas * self.num_replicas if self.even_shards else len(batches)
+        return batches[self.rank:num_batches:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        # batches are formed per pool, so this is a lower bound when shuffling, good enough for progress bars
+        num_batches = len(token_balanced_batches(self.lengths, self.max_tokens, self.pad_multiple, self.max_len))
+        if not self.even_shards:
+            return len(range(self.rank, num_batches, self.num_replicas))
+        return num_batches // self.num_replicas
+
+
+class ResumableBatchSampler(Sampler):
+
+    def __init__(self, batch_sampler):
+        """
+        Wraps a batch sampler whose order is set by its epoch, so that a resumed run can skip the batches it already
+        trained on in its first epoch.
+        :param batch_sampler: BatchSampler over a DistributedSampler, or a LengthBucketBatchSampler.
+        """
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        for sampler in (self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def skip_batches(self, num_batches):
+        """ Skips the first num_batches batches of the next iteration only. """
+        self.skip = num_batches
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return islice(iter(self.batch_sampler), skip, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class TokenizeCollator(object):
+
+    def __init__(self, tokenizer, max_len=None, pad_to_max_length=True, pad_multiple=None, max_tokens=None):
+        """
+        Tokenizes a batch of raw text with a single batch_encode_plus call. Passed as the collate_fn of a DataLoader,
+        tokenization runs in its worker processes and is prefetched ahead of the training loop.
+        :param tokenizer: (transformers.PreTrainedTokenizer) tokenizer to encode the texts with.
+        :param max_len: length to truncate to, defaults to tokenizer.max_len
+        :param pad_to_max_length: pad every batch to max_len if True, otherwise to the longest sequence in the batch.
+        :param pad_multiple: when not padding to max_len, round the longest length up to a multiple of this.
+        :param max_tokens: if set, sequences are sorted by length and returned as a list of batches, each padded
+                           separately and holding at most max_tokens tokens, padding included.
+        """
+        self.tokenizer = tokenizer
+        self.max_len = max_len if max_len is not None else tokenizer.max_len
+        self.pad_to_max_length = pad_to_max_length
+        self.pad_multiple = pad_multiple
+        self.max_tokens = max_tokens
+
+    def texts(self, batch):
+        # WikiDataset yields all the documents of one file, which are flattened into one batch of texts
+        return [text for item in batch for text in ([item] if isinstance(item, str) else item)]
+
+    def pad(self, input_ids, length):
+        inputs = torch.full((len(input_ids), length), self.tokenizer.pad_token_id, dtype=torch.long)
+        for row, ids in zip(inputs, input_ids):
+            row[:len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return inputs
+
+    def padded_length(self, input_ids):
+        if self.pad_to_max_length:
+            return self.max_len
+        return padded_length(max(len(ids) for ids in input_ids), self.pad_multiple, self.max_len)
+
+    def __call__(self, batch):
+        encoded = self.tokenizer.batch_encode_plus(self.texts(batch), add_special_tokens=True, max_length=self.max_len)
+        input_ids = encoded['input_ids']
+
+        if self.max_tokens is None:
+            return self.pad(input_ids, self.padded_length(input_ids))
+
+        lengths = [len(ids) for ids in input_ids]
+        batches = [[input_ids[ind] for ind in batch] for batch in token_balanced_batches(lengths, self.max_tokens, self.pad_multiple, self.max_len)]
+        return [self.pad(batch, self.padded_length(batch)) for batch in batches]
+
+
+def pack_documents(lengths, max_len):
+    """
+    Packs documents into rows of at most max_len tokens, first fit by decreasing length.
+    :param lengths: number of tokens of each document, at most max_len.
+    :return: list of rows, each a list of indices into lengths.
+    """
+    rows, free = [], []
+    for ind in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        row = next((row for row, space in enumerate(free) if space >= lengths[ind]), None)
+        if row is None:
+            rows.append([])
+            free.append(max_len)
+            row = len(rows) - 1
+        rows[row].append(ind)
+        free[row] -= lengths[ind]
+    return rows
+
+
+class PackingCollator(object):
+
+    def __init__(self, max_len, pad_token_id, tokenizer=None):
+        """
+        Packs several documents into each row instead of padding one document per row. Documents are numbered from 1
+        within their row by segment_ids, padding is segment 0, and position_ids restart at every document, to be passed
+        to ReformerLM so attention stays within each document.
+        :param max_len: length of the packed rows, documents are truncated to it.
+        :param pad_token_id: token id of the padding after the last document of a row.
+        :param tokenizer: (transformers.PreTrainedTokenizer) tokenizer to encode raw text with, batches of token ids
+                          (document aligned TokenShardDataset examples) are packed as they are.
+        """
+        self.max_len = max_len
+        self.pad_token_id = pad_token_id
+        self.tokenizer = tokenizer
+
+    def documents(self, batch):
+        if self.tokenizer is None:
+            return [tokens[:self.max_len] for tokens in batch]
+        texts = [text for item in batch for text in ([item] if isinstance(item, str) else item)]
+        encoded = self.tokenizer.batch_encode_plus(texts, add_special_tokens=True, max_length=self.max_len)
+        return encoded['input_ids']
+
+    def __call__(self, batch):
+        """ Returns a dict of input_ids, segment_ids and position_ids LongTensors of shape (rows, max_len). """
+        documents = [doc for doc in self.documents(batch) if len(doc) > 0]
+        rows = pack_documents([len(doc) for doc in documents], self.max_len)
+
+        input_ids = torch.full((len(rows), self.max_len), self.pad_token_id, dtype=torch.long)
+        segment_ids = torch.zeros((len(rows), self.max_len), dtype=torch.long)
+        position_ids = torch.zeros((len(rows), self.max_len), dtype=torch.long)
+
+        for row, docs in enumerate(rows):
+            start = 0
+            for segment, ind in enumerate(docs, start=1):
+                end = start + len(documents[ind])
+                input_ids[row, start:end] = torch.as_tensor(documents[ind], dtype=torch.long)
+                segment_ids[row, start:end] = segment
+                position_ids[row, start:end] = torch.arange(end - start)
+                start = end
+
+        return {'input_ids': input_ids, 'segment_ids': segment_ids, 'position_ids': position_ids}
@@ -0,0 +1,75 @@
+import torch
+import torch.nn.functional as F
+
+
+class MLMMasker(object):
+
+    def __init__(self, tokenizer, mlm_probability=0.15, whole_word=False, span_length=1):
+        """
+        Masks tokens for masked language modeling with tensor ops only, on the device of the inputs:
+        80% [MASK], 10% random, 10% original.
+        :param tokenizer: (transformers.PreTrainedTokenizer) tokenizer the inputs were encoded with.
+        :param mlm_probability: fraction of tokens (or words) to mask.
+        :param whole_word: mask all the word pieces of a word together, words are found through the '##' prefix of
+                           word piece continuations.
+        :param span_length: mask spans of this many consecutive tokens (or words when whole_word is set).
+        """
+        self.mlm_probability = mlm_probability
+        self.whole_word = whole_word
+        self.span_length = span_length
+        self.mask_token_id = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+        self.vocab_size = len(tokenizer)
+
+        # lookup tables by token id, built once instead of per row of every batch
+        special = torch.zeros(self.vocab_size, dtype=torch.bool)
+        special[tokenizer.all_special_ids] = True
+
+        continuation = torch.zeros(self.vocab_size, dtype=torch.bool)
+        if whole_word:
+            tokens = tokenizer.convert_ids_to_tokens(list(range(self.vocab_size)))
+            continuation = torch.tensor([token.startswith('##') for token in tokens], dtype=torch.bool)
+
+        self.tables = {'cpu': (special, continuation)}
+
+    def lookup_tables(self, device):
+        key = str(device)
+        if key not in self.tables:
+            self.tables[key] = tuple(t.to(device) for t in self.tables['cpu'])
+        return self.tables[key]
+
+    def select(self, inputs, special, continuation):
+        # masking decisions are drawn per unit, a token or a whole word, and spread over the span following it
+        batch_size, seq_len = inputs.shape
+        units = torch.arange(seq_len, device=inputs.device).expand(batch_size, -1)
+
+        if self.whole_word:
+            word_starts = ~continuation[inputs] | special[inputs]
+            # rows cut from a token stream can start mid word, the leading word pieces then form a word of their own
+            word_starts[:, 0] = True
+            units = word_starts.long().cumsum(dim=-1) - 1
+
+        probability = self.mlm_probability / self.span_length
+        selected = torch.rand(batch_size, seq_len, device=inputs.device) < probability
+
+        if self.span_length > 1:
+            selected = F.pad(selected.float()[:, None, :], (self.span_length - 1, 0))
+            selected = F.max_pool1d(selected, self.span_length, stride=1)[:, 0].bool()
+
+        return selected.gather(1, units)
+
+    def __call__(self, inputs):
+        """
+        :param inputs: LongTensor of token ids, (batch, seq_len).
+        :return: masked inputs, and labels holding the original ids at masked positions and -100 elsewhere.
+        """
+        special, continuation = self.lookup_tables(inputs.device)
+        masked = self.select(inputs, special, continuation) & ~special[inputs]
+
+        labels = inputs.masked_fill(~masked, -100)
+
+        replace = torch.rand(inputs.shape, device=inputs.device)
+        random_words = torch.randint(self.vocab_size, inputs.shape, dtype=torch.long, device=inputs.device)
+
+        inputs = inputs.masked_fill(masked & (replace < 0.8), self.mask_token_id)
+        inputs = torch.where(masked & (replace >= 0.8) & (replace < 0.9), random_words, inputs)
+        return inputs, labels
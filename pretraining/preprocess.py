@@ -0,0 +1,135 @@
+import os
+import re
+import json
+import logging
+import argparse
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+from transformers import BertTokenizer
+
+NEWLINES = re.compile('\\n')
+WHITESPACE = re.compile('\\s+')
+
+
+def iter_documents(path):
+    """
+    Yields the cleaned text of every document in a directory of wikiextractor json lines files.
+    :param path: directory holding the extracted json lines files.
+    """
+    for file in sorted(os.listdir(path)):
+        path_to_file = os.path.join(path, file)
+        if not os.path.isfile(path_to_file):
+            continue
+
+        with open(path_to_file, encoding='utf-8') as source:
+            for line in source:
+                text = json.loads(line)['text']
+                text = NEWLINES.sub(' ', text)
+                text = WHITESPACE.sub(' ', text)
+                yield text
+
+
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class ShardWriter(object):
+
+    def __init__(self, output_dir, dtype, shard_tokens):
+        """
+        Writes tokenized documents to flat token shards, each with an index of document offsets.
+        :param output_dir: directory to write the shards and metadata to.
+        :param dtype: numpy dtype of the stored tokens, uint16 or uint32.
+        :param shard_tokens: number of tokens after which a new shard is started.
+        """
+        self.output_dir = output_dir
+        self.dtype = dtype
+        self.shard_tokens = shard_tokens
+        self.shards = []
+        self.documents = []
+        self.num_tokens = 0
+
+    def add(self, ids):
+        self.documents.append(np.asarray(ids, dtype=self.dtype))
+        self.num_tokens += len(ids)
+        if self.num_tokens >= self.shard_tokens:
+            self.flush()
+
+    def flush(self):
+        if len(self.documents) == 0:
+            return
+
+        name = f'shard_{len(self.shards):05d}'
+        offsets = np.zeros(len(self.documents) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(doc) for doc in self.documents])
+
+        np.concatenate(self.documents).tofile(os.path.join(self.output_dir, f'{name}.bin'))
+        np.save(os.path.join(self.output_dir, f'{name}.idx.npy'), offsets)
+
+        self.shards.append({'name': name, 'num_tokens': int(offsets[-1]), 'num_documents': len(self.documents)})
+        logging.info(f'{datetime.now()} | Wrote {name} | tokens: {offsets[-1]} | documents: {len(self.documents)}')
+
+        self.documents = []
+        self.num_tokens = 0
+
+
+def preprocess(input_dir, output_dir, tokenizer, shard_tokens=100_000_000, batch_size=1000):
+    """
+    Tokenizes a corpus once into memory mapped token shards, to be served by pretraining.wikidataset.TokenShardDataset
+    :param input_dir: directory of wikiextractor json lines files.
+    :param output_dir: directory to write the shards to.
+    :param tokenizer: (transformers.PreTrainedTokenizer) tokenizer to encode the documents with.
+    :param shard_tokens: number of tokens per shard.
+    :param batch_size: number of documents encoded per call to the tokenizer.
+    :return: the metadata written alongside the shards.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_size = len(tokenizer)
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+    writer = ShardWriter(output_dir, dtype, shard_tokens)
+
+    for texts in tqdm(iter_batches(iter_documents(input_dir), batch_size), desc='Tokenizing'):
+        encoded = tokenizer.batch_encode_plus(texts, add_special_tokens=True)
+        for ids in encoded['input_ids']:
+            writer.add(ids)
+    writer.flush()
+
+    meta = {
+        'dtype': np.dtype(dtype).name,
+        'vocab_size': vocab_size,
+        'pad_token_id': tokenizer.pad_token_id,
+        'shards': writer.shards
+    }
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    return meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenize a wikiextractor corpus into memory mapped token shards')
+    parser.add_argument('--input_dir', default='./data/enwiki', type=str,
+                        help='directory of wikiextractor json lines files')
+    parser.add_argument('--output_dir', default='./data/enwiki_tokens', type=str,
+                        help='directory to write the token shards to')
+    parser.add_argument('--tokenizer', default='bert-base-cased', type=str,
+                        help='name or path of the pretrained BertTokenizer')
+    parser.add_argument('--shard_tokens', default=100_000_000, type=int,
+                        help='number of tokens per shard')
+    parser.add_argument('--batch_size', default=1000, type=int,
+                        help='number of documents encoded per call to the tokenizer')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer)
+    preprocess(args.input_dir, args.output_dir, tokenizer, shard_tokens=args.shard_tokens, batch_size=args.batch_size)
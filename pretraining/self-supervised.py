@@ -1,16 +1,24 @@
 import re
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, BatchSampler, random_split
+from torch.utils.data.distributed import DistributedSampler
 
 from tqdm import tqdm
+from functools import partial
 
 from reformer_pytorch import Reformer, ReformerLM
+from reformer_pytorch.data import Prefetcher
+from reformer_pytorch.distributed import get_rank, get_world_size, broadcast_parameters, all_reduce_gradients, all_reduce_sums, all_gather_tensor, launch
 from transformers import BertTokenizer, PreTrainedTokenizer
 from fairseq.optim.adafactor import Adafactor
+from wikidataset import TokenShardDataset
+from collate import TokenizeCollator, LengthBucketBatchSampler, PackingCollator, ResumableBatchSampler
+from masking import MLMMasker
+from checkpoint import CheckpointManager, append_metrics
 import os
 import json
+import time
 import logging
 from datetime import datetime
 
@@ -61,7 +69,10 @@ class ReformerTrainer(object):
                  eval_batch_size=None,
                  tb_writer=True,
                  tb_dir='./tb_logs',
-                 log_dir='./logs'):
+                 log_dir='./logs',
+                 mlm_probability=0.15,
+                 whole_word_masking=False,
+                 span_length=1):
         """
         Provides an easy to use class for pretraining and evaluating a Reformer Model.
 
@@ -72,6 +83,9 @@ class ReformerTrainer(object):
         :param tb_writer: (bool) Whether to write to tensorboard or not.
         :param tb_dir: (str) Where to write TB logs to.
         :param log_dir: (str) Where to write generic logs to.
+        :param mlm_probability: fraction of tokens to mask for masked language modeling.
+        :param whole_word_masking: (bool) mask all the word pieces of a word together.
+        :param span_length: mask spans of this many consecutive tokens, or words with whole_word_masking.
         """
 
         self.dataset = dataset
@@ -79,16 +93,25 @@ class ReformerTrainer(object):
         self.tokenizer = tokenizer
         self.device = device
         self.n_gpu = torch.cuda.device_count() if torch.cuda.is_available() else 0
+        # with torch.distributed initialized, every process trains a replica on its own device, or on the cpu
+        self.rank = get_rank()
+        self.world_size = get_world_size()
         self.train_batch_size = train_batch_size
         self.eval_batch_size = eval_batch_size
         self.tb_writer = tb_writer
         self.log_dir = log_dir
+        self.max_tokens = None
 
         if tokenizer is None:
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
 
         if device is None:
-            self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+            self.device = f'cuda:{self.rank % self.n_gpu}' if torch.cuda.is_available() else 'cpu'
+
+        if self.world_size > 1:
+            self.n_gpu = min(self.n_gpu, 1)
+
+        self.masker = MLMMasker(self.tokenizer, mlm_probability, whole_word=whole_word_masking, span_length=span_length)
 
         if eval_batch_size is None:
             self.eval_batch_size = train_batch_size
@@ -99,79 +122,99 @@ class ReformerTrainer(object):
 
         logging.basicConfig(filename=f'{log_dir}/{datetime.now().date()}.log', level=logging.INFO)
 
-    def build_dataloaders(self, train_test_split=0.1, train_shuffle=True, eval_shuffle=True):
+    def build_dataloader(self, dataset, batch_size, shuffle, collate_fn, num_workers, pad_multiple, max_tokens,
+                         even_shards=True):
+        lengths = getattr(self.dataset, 'lengths', None)
+        if max_tokens is None or lengths is None:
+            # each process reads its own share of the examples, in an order seeded by the epoch. training shards are
+            # padded to equal lengths with repeated examples, evaluation reads every example once
+            if even_shards or self.world_size == 1:
+                sampler = DistributedSampler(dataset, num_replicas=self.world_size, rank=self.rank, shuffle=shuffle)
+            else:
+                sampler = range(self.rank, len(dataset), self.world_size)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        else:
+            # datasets with known example lengths are bucketed by the sampler, indices are relative to the split
+            lengths = lengths()
+            batch_sampler = LengthBucketBatchSampler([lengths[ind] for ind in dataset.indices], max_tokens,
+                                                     pad_multiple=pad_multiple, max_len=self.dataset.seq_len,
+                                                     shuffle=shuffle, num_replicas=self.world_size, rank=self.rank,
+                                                     even_shards=even_shards)
+
+        # batch orders are reproducible, so a resumed run skips the batches it already trained on
+        return DataLoader(dataset, batch_sampler=ResumableBatchSampler(batch_sampler), collate_fn=collate_fn,
+                          num_workers=num_workers)
+
+    def micro_batches(self, batch, batch_size):
+        # token balanced batches arrive already sized, as a list when one file of documents holds several of them
+        if isinstance(batch, list):
+            return batch
+        if isinstance(batch, dict):
+            return [dict(zip(batch.keys(), tensors)) for tensors in zip(*[t.split(batch_size) for t in batch.values()])]
+        return [batch] if self.max_tokens is not None else batch.split(batch_size)
+
+    def prepare_inputs(self, inputs):
+        """
+        Masks a micro batch on the device. Masking draws from the global random number generator, which revtorch
+        reseeds to recompute the reversible layers in the backward pass, so it runs on the training thread and not
+        ahead of training in the Prefetcher.
+        :return: masked inputs, labels, and the segment and position ids of packed batches as model kwargs.
+        """
+        kwargs = {}
+        if isinstance(inputs, dict):
+            kwargs = {key: value.to(self.device) for key, value in inputs.items() if key != 'input_ids'}
+            inputs = inputs['input_ids']
+        inputs, labels = self.masker(inputs.to(self.device))
+        return inputs, labels, kwargs
+
+    def build_dataloaders(self, train_test_split=0.1, train_shuffle=True, eval_shuffle=True, num_workers=4, pad_multiple=None, max_tokens=None,
+                          pack=False):
         """
         Builds the Training and Eval DataLoaders
 
         :param train_test_split: The ratio split of test to train data.
         :param train_shuffle: (bool) True if you wish to shuffle the train_dataset.
         :param eval_shuffle: (bool) True if you wish to shuffle the eval_dataset.
+        :param num_workers: number of worker processes loading and tokenizing batches ahead of training.
+        :param pad_multiple: pad each batch to its longest sequence rounded up to a multiple of this, rather than to
+                             tokenizer.max_len. Twice the model's bucket_size keeps the LSH buckets whole.
+        :param max_tokens: group sequences of similar length into batches of at most max_tokens tokens, padding
+                           included, instead of batches of a fixed number of sequences.
+        :param pack: (bool) pack several documents into each row of tokenizer.max_len tokens instead of padding them,
+                     attention is kept within documents by segment ids. Document aligned TokenShardDatasets are
+                     packed as they are. Overrides pad_multiple and max_tokens.
         :return: train dataloader and evaluation dataloader.
         """
         dataset_len = len(self.dataset)
         eval_len = int(dataset_len * train_test_split)
         train_len = dataset_len - eval_len
-        train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len))
-        train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, shuffle=train_shuffle)
-        eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle)
+        # seeded, so every process and every resumed run splits the same way
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(0)
+            train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len))
+        # pre-tokenized datasets bring their own collate, raw text is tokenized in the worker processes
+        if pack:
+            pad_multiple, max_tokens = None, None
+
+        self.max_tokens = max_tokens
+        if hasattr(self.dataset, 'pad_multiple'):
+            self.dataset.pad_multiple = pad_multiple
+        collate_fn = getattr(self.dataset, 'collate', None) or TokenizeCollator(self.tokenizer,
+                                                                                pad_to_max_length=pad_multiple is None,
+                                                                                pad_multiple=pad_multiple,
+                                                                                max_tokens=max_tokens)
+        if pack:
+            tokenized = hasattr(self.dataset, 'collate')
+            collate_fn = PackingCollator(self.dataset.seq_len if tokenized else self.tokenizer.max_len,
+                                         self.tokenizer.pad_token_id, tokenizer=None if tokenized else self.tokenizer)
+        train_loader = self.build_dataloader(train_dataset, self.train_batch_size, train_shuffle, collate_fn,
+                                             num_workers, pad_multiple, max_tokens)
+        eval_loader = self.build_dataloader(eval_dataset, self.eval_batch_size, eval_shuffle, collate_fn,
+                                            num_workers, pad_multiple, max_tokens, even_shards=False)
         logging.info(f'''train_dataloader size: {len(train_loader.dataset)} | shuffle: {train_shuffle}
                          eval_dataloader size: {len(eval_loader.dataset)} | shuffle: {eval_shuffle}''')
         return train_loader, eval_loader
 
-    def mask_tokens(self, inputs: torch.Tensor, mlm_probability=0.15, pad=True):
-        """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
-        labels = inputs.clone()
-        # mlm_probability defaults to 0.15 in Bert
-        probability_matrix = torch.full(labels.shape, mlm_probability)
-        special_tokens_mask = [
-            self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-        ]
-        probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
-        if self.tokenizer._pad_token is not None:
-            padding_mask = labels.eq(self.tokenizer.pad_token_id)
-            probability_matrix.masked_fill_(padding_mask, value=0.0)
-        masked_indices = torch.bernoulli(probability_matrix).bool()
-        labels[~masked_indices] = -100  # We only compute loss on masked tokens
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-        inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
-
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
-        inputs[indices_random] = random_words[indices_random]
-
-        if pad:
-            input_pads = self.tokenizer.max_len - inputs.shape[-1]
-            label_pads = self.tokenizer.max_len - labels.shape[-1]
-
-            inputs = F.pad(inputs, pad=(0, input_pads), value=self.tokenizer.pad_token_id)
-            labels = F.pad(labels, pad=(0, label_pads), value=self.tokenizer.pad_token_id)
-
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-        return inputs, labels
-
-    def _tokenize_input_ids(self, input_ids: list, pad_to_max_length: bool = True):
-        """
-        Helper function to clean up the train and eval functions
-        :param input_ids: inputs to tokenize.
-        :param pad_to_max_length: Whether you want to pad the inputs to the tokenizer.max_len
-        :return: Tensor containing training data.
-        """
-        inputs = torch.cat(
-            [
-                self.tokenizer.encode(
-                    input_ids[i],
-                    add_special_tokens=True,
-                    max_length=self.tokenizer.max_len,
-                    pad_to_max_length=pad_to_max_length,
-                    return_tensors='pt'
-                ) \
-                for i in range(len(input_ids))
-            ]
-        )
-        return inputs
 
     def train(self,
               epochs,
@@ -180,7 +223,9 @@ class ReformerTrainer(object):
               log_steps,
               ckpt_steps,
               ckpt_dir=None,
-              gradient_accumulation_steps=1):
+              gradient_accumulation_steps=1,
+              eval_steps=None,
+              keep_checkpoints=3):
         """
         Trains the Reformer Model
         :param epochs: The number of times you wish to loop through the dataset.
@@ -188,142 +233,258 @@ class ReformerTrainer(object):
         :param eval_dataloader: (torch.utils.data.DataLoader) The data to evaluate on.
         :param log_steps: The number of steps to iterate before logging.
         :param ckpt_steps: The number of steps to iterate before checkpointing.
-        :param ckpt_dir: The directory to save the checkpoints to.
-        :param gradient_accumulation_steps: Optional gradient accumulation.
-        :return: Total number of steps, total loss, model
+        :param ckpt_dir: The directory to save the checkpoints to. Training resumes from the latest checkpoint in it,
+                         with the optimizer state, the step counters and the position in train_dataloader.
+        :param gradient_accumulation_steps: number of micro batches whose gradients are accumulated before each
+                                            optimizer step. log_steps, ckpt_steps and eval_steps count optimizer steps.
+        :param eval_steps: The number of steps to iterate before evaluating, defaults to ckpt_steps.
+        :param keep_checkpoints: number of most recent checkpoints kept in ckpt_dir.
+        :return: model
         """
 
         optimizer = Adafactor(self.model.parameters())
-        loss_fn = nn.CrossEntropyLoss()
-        losses = {}
         global_steps = 0
+        micro_steps = 0
+        start_epoch = 0
+        start_batch = 0
+        start_micro_batch = 0
+        # random number generator states to continue from, (cpu, cuda)
+        resume_rng_states = None, None
         local_steps = 0
         step_loss = 0.0
-
-        if ckpt_dir is not None:
-            assert os.path.isdir(ckpt_dir)
-            try:
-                logging.info(f'{datetime.now()} | Continuing from checkpoint...')
-                self.model.load_state_dict(torch.load(f'{ckpt_dir}/model_state_dict.pt', map_location=self.device))
-                optimizer.load_state_dict(torch.load(f'{ckpt_dir}/optimizer_state_dict.pt'))
-
-            except Exception as e:
-                logging.info(f'{datetime.now()} | No checkpoint was found | {e}')
+        accumulated_loss = 0.0
+        log_tokens = 0
+        eval_steps = eval_steps if eval_steps is not None else ckpt_steps
+        metrics_path = f'{self.log_dir}/metrics.jsonl'
 
         self.model.train()
+        self.model.to(self.device)
+        logging.info(f'{datetime.now()} | Moved model to: {self.device}')
+
+        # checkpoints are written by the first process only, and read by all of them
+        checkpoints = CheckpointManager(ckpt_dir, keep_last=keep_checkpoints) if ckpt_dir is not None else None
+        checkpoint = checkpoints.load(map_location=self.device) if checkpoints is not None else None
+
+        if checkpoint is not None:
+            model_state, optimizer_state, state = checkpoint
+            self.model.load_state_dict(model_state)
+            optimizer.load_state_dict(optimizer_state)
+            global_steps, micro_steps = state['global_steps'], state['micro_steps']
+            start_epoch, start_batch, start_micro_batch = state['epoch'], state['batch'], state['micro_batch']
+            # processes can be at different micro batches, their shares of the data split differently
+            if self.rank < len(state.get('positions', [])):
+                start_batch, start_micro_batch = state['positions'][self.rank].tolist()
+            # each process continues its own random numbers, those of a process new to the run are left as they are.
+            # they are restored once the resumed epoch's batches are iterated, see below
+            if self.rank < len(state['rng_states']):
+                resume_rng_states = state['rng_states'][self.rank].cpu(), resume_rng_states[1]
+            if torch.cuda.is_available() and self.rank < len(state.get('cuda_rng_states', [])):
+                cuda_rng_states = [rng_state.cpu() for rng_state in state['cuda_rng_states'][self.rank]]
+                resume_rng_states = resume_rng_states[0], cuda_rng_states
+            logging.info(f'{datetime.now()} | Continuing from checkpoint at step {global_steps}...')
 
         if self.n_gpu > 1:
             self.model = nn.DataParallel(self.model)
             logging.info(f'{datetime.now()} | Utilizing {self.n_gpu} GPUs')
 
-        self.model.to(self.device)
-        logging.info(f'{datetime.now()} | Moved model to: {self.device}')
+        if self.world_size > 1:
+            broadcast_parameters(self.model)
+            logging.info(f'{datetime.now()} | Process {self.rank} of {self.world_size}')
         logging.info(
             f'{datetime.now()} | train_batch_size: {self.train_batch_size} | eval_batch_size: {self.eval_batch_size}')
-        logging.info(f'{datetime.now()} | Epochs: {epochs} | log_steps: {log_steps} | ckpt_steps: {ckpt_steps}')
+        logging.info(f'{datetime.now()} | Epochs: {epochs} | log_steps: {log_steps} | ckpt_steps: {ckpt_steps} | eval_steps: {eval_steps}')
         logging.info(f'{datetime.now()} | gradient_accumulation_steps: {gradient_accumulation_steps}')
 
-        for epoch in tqdm(range(epochs), desc='Epochs', position=0):
+        def save_checkpoint(epoch, batch, micro_batch):
+            # called on every process, to gather the position in the data and random number generator state of each
+            state = {
+                'epoch': epoch,
+                'batch': batch,
+                'micro_batch': micro_batch,
+                'global_steps': global_steps,
+                'micro_steps': micro_steps,
+                'positions': all_gather_tensor(torch.tensor([batch, micro_batch]), self.device),
+                'rng_states': all_gather_tensor(torch.get_rng_state(), self.device)
+            }
+            if torch.cuda.is_available():
+                cuda_rng_states = all_gather_tensor(torch.stack(torch.cuda.get_rng_state_all()), self.device)
+                state['cuda_rng_states'] = [list(rng_states) for rng_states in cuda_rng_states]
+
+            if self.rank == 0:
+                model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
+                checkpoints.save(global_steps, model_to_save, optimizer, state)
+
+        def run_schedule(epoch, batch, micro_batch):
+            # evaluation and checkpoints run collectives, so every process runs them after the same optimizer steps,
+            # including processes out of batches that only step along with the others
+            nonlocal log_start
+
+            if global_steps % eval_steps == 0:
+                # every process evaluates its share of the eval split, and the totals are summed
+                eval_metrics = self.evaluate(eval_dataloader)
+                if self.rank == 0:
+                    append_metrics(metrics_path, global_steps, **eval_metrics)
+                self.model.train()
+                # evaluation is not training throughput
+                log_start = time.time()
+
+            if checkpoints is not None and global_steps % ckpt_steps == 0:
+                # only the copy to host memory happens here, the checkpoint is written in the background
+                save_checkpoint(epoch, batch, micro_batch)
+
+        log_start = time.time()
+
+        for epoch in tqdm(range(start_epoch, epochs), desc='Epochs', position=0):
             logging.info(f'{datetime.now()} | Epoch: {epoch}')
-            for step, batch in tqdm(enumerate(train_dataloader),
+            for sampler in (train_dataloader.sampler, train_dataloader.batch_sampler):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
+
+            # a resumed epoch skips the batches, and micro batches of the next one, trained on before the checkpoint
+            skip_batches, skip_micro_batches = (start_batch, start_micro_batch) if epoch == start_epoch else (0, 0)
+            if skip_batches > 0:
+                train_dataloader.batch_sampler.skip_batches(skip_batches)
+
+            # batches arrive tokenized from the DataLoader workers, and are moved to the device and split into micro
+            # batches on a background thread while the model trains on the previous batch
+            train_batches = Prefetcher(train_dataloader, self.device,
+                                       transform=partial(self.micro_batches, batch_size=self.train_batch_size))
+            batches = iter(train_batches)
+            # the DataLoader draws its workers' base seed from the global generator as its iterator is created, which
+            # the checkpointed run did at the start of the epoch, so the random number generators are restored after
+            rng_state, cuda_rng_states = resume_rng_states
+            if rng_state is not None:
+                torch.set_rng_state(rng_state)
+            if cuda_rng_states is not None:
+                torch.cuda.set_rng_state_all(cuda_rng_states)
+            resume_rng_states = None, None
+            # the last batch trained on, for processes whose share has no batches left
+            step = skip_batches - 1
+            for step, batch in tqdm(enumerate(batches, start=skip_batches),
                                     desc='Epoch Iterator',
                                     position=1,
                                     leave=True,
-                                    total=len(train_dataloader)):
-                for data in batch:
-                    inputs = self._tokenize_input_ids(data, pad_to_max_length=True)
-                    inputs, labels = self.mask_tokens(inputs)
-                    inputs, labels = inputs.to(self.device), labels.to(self.device)
-                    output = self.model(inputs)
+                                    initial=skip_batches,
+                                    total=len(train_batches)):
+                for micro_batch, inputs in enumerate(batch):
+                    if skip_micro_batches > 0:
+                        skip_micro_batches -= 1
+                        continue
 
-                    # only calculating loss on masked tokens
-                    loss_mx = labels != -100
-                    output = output[loss_mx].view(-1, self.tokenizer.vocab_size)
-                    labels = labels[loss_mx].view(-1)
+                    inputs, labels, kwargs = self.prepare_inputs(inputs)
+
+                    micro_steps += 1
+                    sync = micro_steps % gradient_accumulation_steps == 0
 
-                    loss = loss_fn(output, labels)
+                    # only calculating loss on masked tokens
+                    loss = self.model(inputs, labels=labels, **kwargs)
 
-                    if gradient_accumulation_steps > 1:
-                        loss /= gradient_accumulation_steps
+                    if self.n_gpu > 1:
+                        loss = loss.mean()
 
+                    loss = loss / gradient_accumulation_steps
                     loss.backward()
+
+                    # kept on the device, read once per optimizer step
+                    accumulated_loss += loss.detach()
+                    log_tokens += inputs.ne(self.tokenizer.pad_token_id).sum()
+
+                    if not sync:
+                        continue
+
+                    if self.world_size > 1:
+                        all_reduce_gradients(self.model)
+
                     optimizer.step()
                     self.model.zero_grad()
 
-                    step_loss += loss.item()
-                    losses[global_steps] = loss.item()
+                    step_loss += accumulated_loss.item()
+                    accumulated_loss = 0.0
                     local_steps += 1
                     global_steps += 1
 
                     if global_steps % log_steps == 0:
+                        train_loss = step_loss / local_steps
+                        tokens_per_sec = int(log_tokens) / (time.time() - log_start)
                         if self.tb_writer:
-                            self.writer.add_scalar('Train/Loss', step_loss / local_steps, global_steps)
+                            self.writer.add_scalar('Train/Loss', train_loss, global_steps)
+                            self.writer.add_scalar('Train/TokensPerSec', tokens_per_sec, global_steps)
                             self.writer.close()
                         logging.info(
-                            f'''{datetime.now()} | Train Loss: {step_loss / local_steps} | Steps: {global_steps}''')
+                            f'''{datetime.now()} | Train Loss: {train_loss} | Steps: {global_steps} | Tokens/sec: {tokens_per_sec:.0f}''')
 
-                        with open(f'{self.log_dir}/train_results.json', 'w') as results_file:
-                            json.dump(losses, results_file)
-                            results_file.close()
+                        if self.rank == 0:
+                            append_metrics(metrics_path, global_steps, train_loss=train_loss,
+                                           tokens_per_sec=tokens_per_sec)
                         step_loss = 0.0
                         local_steps = 0
+                        log_tokens = 0
+                        log_start = time.time()
+
+                    run_schedule(epoch, step, micro_batch + 1)
+
+            if self.world_size > 1:
+                # a partial accumulation is dropped, and processes out of batches keep stepping along with the others
+                # until all of them are done, so the replicas stay identical. a checkpoint taken meanwhile resumes this
+                # process past all of its batches
+                micro_steps -= micro_steps % gradient_accumulation_steps
+                accumulated_loss = 0.0
+                self.model.zero_grad()
+                while all_reduce_gradients(self.model, active=False) > 0:
+                    optimizer.step()
+                    self.model.zero_grad()
+                    global_steps += 1
+                    run_schedule(epoch, step + 1, 0)
 
-                    if global_steps % ckpt_steps == 0:
-                        # evaluating before every checkpoint
-                        self.evaluate(eval_dataloader)
-                        model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
-                        torch.save(model_to_save.state_dict(), f'{ckpt_dir}/model_state_dict.pt')
-                        torch.save(optimizer.state_dict(), f'{ckpt_dir}/optimizer_state_dict.pt')
-
-                        logging.info(f'{datetime.now()} | Saved checkpoint to: {ckpt_dir}')
+        # gradients left over from a partial accumulation at the end of training
+        if micro_steps % gradient_accumulation_steps != 0:
+            optimizer.step()
+            self.model.zero_grad()
 
-        model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
-        torch.save(model_to_save.state_dict(), f'{ckpt_dir}/model_state_dict.pt')
-        torch.save(optimizer.state_dict(), f'{ckpt_dir}/optimizer_state_dict.pt')
+        if checkpoints is not None:
+            save_checkpoint(epochs, 0, 0)
+            checkpoints.close()
 
         return self.model
 
     def evaluate(self, dataloader):
         """
-        Runs through the provided dataloader with torch.no_grad()
-        :param dataloader: (torch.utils.data.DataLoader) Evaluation DataLoader
-        :return: None
+        Runs through the provided dataloader with torch.no_grad(), on every process when distributed.
+        :param dataloader: (torch.utils.data.DataLoader) Evaluation DataLoader, holding this process's share.
+        :return: dict of the mean eval_loss and perplexity over all processes.
         """
-        loss_fn = nn.CrossEntropyLoss()
 
         if self.n_gpu > 1 and not isinstance(self.model, nn.DataParallel):
             self.model = nn.DataParallel(self.model)
 
         self.model.eval()
-        eval_loss = 0.0
-        perplexity = 0.0
+        total_loss = 0.0
+        total_perplexity = 0.0
         eval_steps = 0
+        eval_loss = float('nan')
+        perplexity = float('nan')
 
         logging.info(f'{datetime.now()} | Evaluating...')
-        for step, batch in tqdm(enumerate(dataloader), desc='Evaluating', leave=True, total=len(dataloader)):
-            for data in batch:
-                inputs = self._tokenize_input_ids(data, pad_to_max_length=True)
-                inputs, labels = self.mask_tokens(inputs)
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
+        eval_batches = Prefetcher(dataloader, self.device,
+                                  transform=partial(self.micro_batches, batch_size=self.eval_batch_size))
+        for step, batch in tqdm(enumerate(eval_batches), desc='Evaluating', leave=True, total=len(eval_batches)):
+            for inputs in batch:
+                inputs, labels, kwargs = self.prepare_inputs(inputs)
 
                 with torch.no_grad():
-                    output = self.model(inputs)
-
-                loss_mx = labels != -100
-                output_ids = output[loss_mx].view(-1, self.tokenizer.vocab_size)
-                labels = labels[loss_mx].view(-1)
-                tmp_eval_loss = loss_fn(output_ids, labels)
-                tmp_perplexity = torch.exp(tmp_eval_loss)
+                    tmp_eval_loss = self.model(inputs, labels=labels, **kwargs)
 
                 if self.n_gpu > 1:
                     tmp_eval_loss = tmp_eval_loss.mean()
 
-                eval_loss += tmp_eval_loss.item()
-                perplexity += tmp_perplexity.item()
+                tmp_perplexity = torch.exp(tmp_eval_loss)
+
+                total_loss += tmp_eval_loss.item()
+                total_perplexity += tmp_perplexity.item()
                 eval_steps += 1
 
-            eval_loss /= eval_steps
-            perplexity /= eval_steps
+            eval_loss = total_loss / eval_steps
+            perplexity = total_perplexity / eval_steps
 
             if self.tb_writer:
                 self.writer.add_scalar('Eval/Loss', eval_loss, eval_steps)
@@ -332,13 +493,29 @@ class ReformerTrainer(object):
                 self.writer.close()
             logging.info(f'{datetime.now()} | Step: {step} | Eval Loss: {eval_loss} | Perplexity: {perplexity}')
 
-        return None
+        if self.world_size > 1:
+            total_loss, total_perplexity, eval_steps = all_reduce_sums((total_loss, total_perplexity, eval_steps),
+                                                                        self.device)
+            eval_loss = total_loss / eval_steps if eval_steps > 0 else float('nan')
+            perplexity = total_perplexity / eval_steps if eval_steps > 0 else float('nan')
+            logging.info(f'{datetime.now()} | All processes | Eval Loss: {eval_loss} | Perplexity: {perplexity}')
 
+        return {'eval_loss': eval_loss, 'perplexity': perplexity}
 
-if __name__ == '__main__':
-    dataset = WikiDataset(path='./data/enwiki')
+
+def main(rank=0, world_size=1):
+    """
+    Pretrains a ReformerLM on the english wikipedia.
+    :param rank: rank of this process, when launched as one of several.
+    :param world_size: number of processes training together.
+    """
     tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
     tokenizer.max_len = 128
+    # corpora tokenized ahead of time with preprocess.py are read from memory mapped shards
+    if os.path.isdir('./data/enwiki_tokens'):
+        dataset = TokenShardDataset(path='./data/enwiki_tokens', seq_len=tokenizer.max_len)
+    else:
+        dataset = WikiDataset(path='./data/enwiki')
     model = ReformerLM(
         num_tokens=tokenizer.vocab_size,
         dim=512,
@@ -364,4 +541,14 @@ if __name__ == '__main__':
                           ckpt_steps=100,
                           ckpt_dir='./ckpts',
                           gradient_accumulation_steps=1)
-    torch.save(model, './ckpts/model.bin')
+    if rank == 0:
+        torch.save(model, './ckpts/model.bin')
+
+
+if __name__ == '__main__':
+    # one process per device, or per cpu socket with the gloo backend: NUM_PROCESSES=4 python self-supervised.py
+    num_processes = int(os.environ.get('NUM_PROCESSES', 1))
+    if num_processes > 1:
+        launch(main, num_processes, backend=os.environ.get('DIST_BACKEND', 'gloo'))
+    else:
+        main()
@@ -1,7 +1,10 @@
 import re
 import os
 import json
+import numpy as np
+import torch
 from torch.utils.data.dataset import Dataset
+from collate import padded_length
 
 
 class WikiDataset(Dataset):
@@ -37,3 +40,90 @@ class WikiDataset(Dataset):
                 items.append(text)
 
         return items
+
+
+class TokenShardDataset(Dataset):
+
+    def __init__(self, path="", seq_len=128, document_aligned=False, pad_multiple=None):
+        """
+        Serves token slices from the memory mapped shards written by pretraining/preprocess.py, without copying.
+        :param path: directory holding the shards and meta.json.
+        :param seq_len: number of tokens per example.
+        :param document_aligned: if True every example starts at a document boundary, with documents longer than
+                                 seq_len split into several examples, and shorter ones left short. Otherwise the
+                                 token stream of each shard is cut into consecutive seq_len slices.
+        :param pad_multiple: pad document aligned batches to a multiple of this rather than to seq_len.
+        """
+        assert os.path.isdir(path)
+
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.seq_len = seq_len
+        self.document_aligned = document_aligned
+        self.pad_multiple = pad_multiple
+        self.pad_token_id = self.meta['pad_token_id']
+
+        # shards are memory mapped lazily in each process, so DataLoader workers never pickle their contents
+        self.shard_paths = [os.path.join(path, f"{shard['name']}.bin") for shard in self.meta['shards']]
+        self.shards = None
+
+        if document_aligned:
+            # (shard, start, end) of each example
+            examples = []
+            for ind, shard in enumerate(self.meta['shards']):
+                offsets = np.load(os.path.join(path, f"{shard['name']}.idx.npy"))
+                starts, ends = offsets[:-1], offsets[1:]
+                chunks = (ends - starts + seq_len - 1) // seq_len
+                chunk_starts = np.repeat(starts, chunks) + seq_len * (np.arange(chunks.sum()) - np.repeat(np.cumsum(chunks) - chunks, chunks))
+                chunk_ends = np.minimum(chunk_starts + seq_len, np.repeat(ends, chunks))
+                examples.append(np.stack([np.full_like(chunk_starts, ind), chunk_starts, chunk_ends], axis=1))
+            self.examples = np.concatenate(examples)
+        else:
+            self.shard_examples = np.cumsum([shard['num_tokens'] // seq_len for shard in self.meta['shards']])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def open_shards(self):
+        if self.shards is None:
+            self.shards = [np.memmap(shard_path, dtype=self.meta['dtype'], mode='r') for shard_path in self.shard_paths]
+        return self.shards
+
+    def __len__(self):
+        """ Returns the number of examples. """
+        if self.document_aligned:
+            return len(self.examples)
+        return int(self.shard_examples[-1]) if len(self.shard_examples) > 0 else 0
+
+    def lengths(self):
+        """ Returns the number of tokens of each example, for length bucketing. """
+        if self.document_aligned:
+            return (self.examples[:, 2] - self.examples[:, 1]).tolist()
+        return [self.seq_len] * len(self)
+
+    def __getitem__(self, idx):
+        """ Returns a read only view of the tokens of one example. """
+        if self.document_aligned:
+            shard, start, end = self.examples[idx]
+        else:
+            shard = int(np.searchsorted(self.shard_examples, idx, side='right'))
+            start = (idx - (self.shard_examples[shard - 1] if shard > 0 else 0)) * self.seq_len
+            end = start + self.seq_len
+
+        return self.open_shards()[shard][start:end]
+
+    def collate(self, batch):
+        """
+        Stacks a batch of examples into a LongTensor, padding document aligned examples to the longest one,
+        rounded up to pad_multiple.
+        :param batch: list of token views returned by __getitem__.
+        :return: LongTensor of shape (batch, length).
+        """
+        length = padded_length(max(len(tokens) for tokens in batch), self.pad_multiple, self.seq_len)
+        inputs = np.full((len(batch), length), self.pad_token_id, dtype=np.int64)
+        for row, tokens in zip(inputs, batch):
+            row[:len(tokens)] = tokens
+        return torch.from_numpy(inputs)
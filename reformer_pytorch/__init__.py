@@ -1,2 +1,6 @@
-from reformer_pytorch.reformer_pytorch import LSHAttention, LSHSelfAttention, Reformer, ReformerLM
+from reformer_pytorch.reformer_pytorch import LSHAttention, LSHSelfAttention, Reformer, ReformerLM, lsh_settings
 from reformer_pytorch.recorder import Recorder
+from reformer_pytorch.profiler import Profiler
+from reformer_pytorch.monitor import BucketMonitor
+from reformer_pytorch.diagnostics import lsh_recall_report, cheapest_n_hashes
+from reformer_pytorch.data import MemmapByteDataset, Prefetcher, extract
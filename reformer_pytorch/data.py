@@ -0,0 +1,211 @@
+import os
+import sys
+import gzip
+import shutil
+from queue import Queue, Full
+from threading import Thread, Event
+from contextlib import contextmanager
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+# memory maps need the raw bytes, so gzipped files are extracted once, to a path of the caller's choosing
+
+def extract(path, raw_path):
+    if not os.path.exists(raw_path):
+        tmp_path = f'{raw_path}.{os.getpid()}.tmp'
+        with gzip.open(path) as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, raw_path)
+    return raw_path
+
+# random crops of a byte level corpus, memory mapped and gathered a batch at a time
+# yields (inputs, targets) batches on the cpu, use with DataLoader(dataset, batch_size = None)
+
+class MemmapByteDataset(IterableDataset):
+    def __init__(self, path, seq_len, batch_size, start = 0, end = None, pin_memory = False):
+        super().__init__()
+        assert not path.endswith('.gz'), f'{path} must be extracted first, with reformer_pytorch.data.extract(path, raw_path)'
+        self.path = path
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.start = start
+        self.end = end
+        self.pin_memory = pin_memory
+        self.data = None
+
+        assert len(self) > 0, f'the range of bytes must be longer than seq_len + 1 ({seq_len + 1})'
+
+    def __getstate__(self):
+        # each DataLoader worker maps the file itself
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def open(self):
+        if self.data is None:
+            import numpy as np
+            self.data = np.memmap(self.path, dtype = np.uint8, mode = 'r')
+        return self.data
+
+    def __len__(self):
+        end = self.end if self.end is not None else os.path.getsize(self.path)
+        return (end - self.start) // self.seq_len
+
+    def sample(self, batch_size = None):
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        data = self.open()
+        end = self.end if self.end is not None else len(data)
+
+        # offsets from the torch generator, which DataLoader seeds differently in every worker
+        # crops of seq_len + 1 bytes, up to the one ending at end
+        offsets = torch.randint(self.start, end - self.seq_len, (batch_size, 1))
+        indices = offsets + torch.arange(self.seq_len + 1)
+        seq = torch.from_numpy(data[indices.numpy()]).long()
+        x, y = seq[:, :-1].contiguous(), seq[:, 1:].contiguous()
+
+        # pin in the main process only, workers are pinned by DataLoader(pin_memory = True)
+        if self.pin_memory and get_worker_info() is None and torch.cuda.is_available():
+            x, y = x.pin_memory(), y.pin_memory()
+
+        return x, y
+
+    def __iter__(self):
+        while True:
+            yield self.sample()
+
+# helpers
+
+def map_tensors(fn, data):
+    if torch.is_tensor(data):
+        return fn(data)
+    if isinstance(data, dict):
+        return {key: map_tensors(fn, value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(map_tensors(fn, value) for value in data)
+    return data
+
+@contextmanager
+def null_context():
+    yield
+
+# prepares the next batches of a loader on a background thread, while the model computes on the current one
+# batches are staged through pinned host buffers, reused round robin, and copied with non blocking transfers on a
+# side stream. transform, such as splitting into micro batches, then runs on the device batch, still on the background
+# thread. it must not draw from the global random number generator: reversible layers reseed it to recompute their
+# forward in the backward pass, and a concurrent draw would change the recomputed dropout and hashes
+
+class Prefetcher(object):
+    def __init__(self, loader, device, depth = 2, transform = None):
+        self.loader = loader
+        self.device = torch.device(device) if not isinstance(device, int) else torch.device('cuda', device)
+        self.depth = depth
+        self.transform = transform
+
+        self.cuda = self.device.type == 'cuda'
+        # a buffer is written again only after the copy out of it is done, with depth batches queued,
+        # one being consumed and one being prepared, depth + 2 buffers never wait in steady state
+        self.num_buffers = depth + 2
+        self.buffers = {}
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stage(self, t):
+        if t.is_pinned():
+            return t
+
+        slots = self.buffers.setdefault(t.dtype, [])
+        if len(slots) < self.num_buffers:
+            slots.append([torch.empty(0, dtype = t.dtype).pin_memory(), None])
+
+        slot = slots.pop(0)
+        slots.append(slot)
+        buffer, event = slot
+
+        if event is not None:
+            event.synchronize()
+
+        if buffer.numel() < t.numel():
+            buffer = slot[0] = torch.empty(t.numel(), dtype = t.dtype).pin_memory()
+
+        staged = buffer[:t.numel()].view(t.shape)
+        staged.copy_(t)
+        return staged
+
+    def to_device(self, t):
+        if not self.cuda:
+            return t.to(self.device)
+
+        staged = self.stage(t)
+        out = staged.to(self.device, non_blocking = True)
+
+        if staged is not t:
+            event = torch.cuda.Event()
+            event.record()
+            self.buffers[t.dtype][-1][1] = event
+        return out
+
+    def produce(self, iterator, queue, done):
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+        context = torch.cuda.stream(stream) if self.cuda else null_context()
+
+        def put(item):
+            while not done.is_set():
+                try:
+                    queue.put(item, timeout = 0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        try:
+            with context:
+                for batch in iterator:
+                    batch = map_tensors(self.to_device, batch)
+                    if self.transform is not None:
+                        batch = self.transform(batch)
+
+                    event = None
+                    if self.cuda:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+
+                    if not put((batch, event, None)):
+                        return
+        except Exception:
+            put((None, None, sys.exc_info()))
+            return
+
+        put(None)
+
+    def __iter__(self):
+        # the loader iterator is created here, on the calling thread and as soon as iter() is called rather than
+        # on the first batch, as DataLoader draws its worker base seed from the global generator
+        iterator = iter(self.loader)
+        queue, done = Queue(maxsize = self.depth), Event()
+        thread = Thread(target = self.produce, args = (iterator, queue, done), daemon = True)
+        thread.start()
+        return self.consume(queue, done, thread)
+
+    def consume(self, queue, done, thread):
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+
+                batch, event, exc_info = item
+                if exc_info is not None:
+                    raise exc_info[1].with_traceback(exc_info[2])
+
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    # memory allocated on the side stream is now also in use on the current one
+                    map_tensors(lambda t: t.record_stream(stream) if t.is_cuda else None, batch)
+
+                yield batch
+        finally:
+            done.set()
+            thread.join()
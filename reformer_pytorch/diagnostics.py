@@ -0,0 +1,115 @@
+import torch
+import torch.nn.functional as F
+from reformer_pytorch.reformer_pytorch import LSHAttention, FullQKAttention, LSHSelfAttention, SettableArgs, process_inputs_chunk, expand_input_mask, expand_segment_ids
+
+# measures how well LSH attention approximates full attention, layer by layer, for a grid of hash rounds
+
+def capture_attention_inputs(net, *args, **kwargs):
+    # the inputs to each self attention call, in call order, so layers sharing tied weights are told apart
+    captured = []
+    settables = {id(m.fn): m for m in net.modules() if isinstance(m, SettableArgs) and isinstance(m.fn, LSHSelfAttention)}
+
+    def hook(module, inputs):
+        # keys and masks are handed to attention through the settable args wrapping it
+        settable = settables.get(id(module))
+        kwargs = settable.kwargs if settable is not None else {}
+        masks = {name: kwargs[name] for name in ('input_mask', 'segment_ids') if kwargs.get(name) is not None}
+        captured.append((module, inputs[0], kwargs.get('keys'), masks))
+
+    hooks = [m.register_forward_pre_hook(hook) for m in net.modules() if isinstance(m, LSHSelfAttention)]
+
+    try:
+        with torch.no_grad():
+            net(*args, **kwargs)
+    finally:
+        for h in hooks:
+            h.remove()
+
+    return captured
+
+def attention_qkv(module, x, keys = None, masks = None):
+    # the shared query / keys, values and masks exactly as LSHSelfAttention computes them, heads merged into the batch
+    b, t, e, h, m = *x.shape, module.heads, module.num_mem_kv
+    mem = module.mem_kv.expand(b, m, e)
+    keys = keys if keys is not None else torch.empty(b, 0, e, dtype=mem.dtype, device=x.device)
+
+    x = torch.cat((x, mem, keys), dim=1)
+    kv_len = x.shape[1]
+
+    def merge_heads(v):
+        return v.view(b, kv_len, h, -1).transpose(1, 2).reshape(b * h, kv_len, -1)
+
+    expand = {'input_mask': expand_input_mask, 'segment_ids': expand_segment_ids}
+    masks = {name: mask if mask.shape == (b * h, kv_len) else expand[name](mask, h, kv_len, x.device) for name, mask in (masks or {}).items()}
+
+    return merge_heads(module.toqk(x)), merge_heads(module.tov(x)), t, masks
+
+def compare_attention(lsh_attn, full_attn, qk, v, query_len, top_k, chunks = 1, masks = None):
+    # both attentions see the same padding and segment masks, chunked along with the merged heads
+    masks = masks or {}
+
+    def attend(attn):
+        return lambda qk, v, *mask_chunks: attn(qk, v, query_len = query_len, **dict(zip(masks.keys(), mask_chunks)))
+
+    lsh_out, lsh_weights, _ = process_inputs_chunk(attend(lsh_attn), qk, v, *masks.values(), chunks = chunks)
+    full_out, full_weights, _ = process_inputs_chunk(attend(full_attn), qk, v, *masks.values(), chunks = chunks)
+
+    # keys any hash round let the query attend to
+    attended = lsh_weights > 0
+
+    k = min(top_k, full_weights.shape[-1])
+    top_weights, top_indices = full_weights.topk(k, dim=-1)
+    # under causal masking early queries have fewer than k keys to attend to
+    valid = top_weights > 0
+    hits = attended.gather(-1, top_indices) & valid
+
+    return {
+        'topk_recall': (hits.sum().float() / valid.sum().clamp(min=1).float()).item(),
+        'attention_mass': (full_weights * attended.float()).sum(dim=-1).mean().item(),
+        'cosine_error': (1 - F.cosine_similarity(lsh_out, full_out, dim=-1)).mean().item()
+    }
+
+def lsh_recall_report(net, *args, n_hashes = (1, 2, 4, 8), top_k = 32, **kwargs):
+    captured = capture_attention_inputs(net, *args, **kwargs)
+
+    report = {}
+    with torch.no_grad():
+        for layer, (module, x, keys, masks) in enumerate(captured):
+            qk, v, query_len, masks = attention_qkv(module, x, keys, masks)
+            kv_len = qk.shape[1]
+
+            # layers running full attention have nothing to approximate
+            if module.use_full_attn or kv_len <= module.full_attn_thres:
+                continue
+
+            lsh = module.lsh_attn
+            full_attn = FullQKAttention(causal = lsh.causal)
+
+            report[layer] = {}
+            for rounds in n_hashes:
+                lsh_attn = LSHAttention(
+                    bucket_size = lsh.bucket_size,
+                    n_hashes = rounds,
+                    causal = lsh.causal,
+                    allow_duplicate_attention = lsh._allow_duplicate_attention,
+                    attend_across_buckets = lsh._attend_across_buckets,
+                    rehash_each_round = lsh._rehash_each_round,
+                    random_rotations_per_head = lsh._random_rotations_per_head,
+                    return_attn = True
+                )
+
+                report[layer][rounds] = compare_attention(lsh_attn, full_attn, qk, v, query_len, top_k, chunks = module.attn_chunks, masks = masks)
+
+    return report
+
+def cheapest_n_hashes(report, target, metric = 'topk_recall'):
+    # fewest hash rounds meeting the target on every layer, None if no setting in the grid does
+    lower_is_better = metric == 'cosine_error'
+    grid = sorted(set(rounds for layer in report.values() for rounds in layer.keys()))
+
+    for rounds in grid:
+        values = [layer[rounds][metric] for layer in report.values()]
+        if all((value <= target) if lower_is_better else (value >= target) for value in values):
+            return rounds
+
+    return None
@@ -0,0 +1,92 @@
+import os
+from itertools import chain
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+# data parallel training across processes, with the gloo backend on cpu only machines
+# DistributedDataParallel all-reduces gradients from hooks fired as autograd reaches each parameter, which does not
+# hold up with reversible layers, whose backward reruns the forward of each block within revtorch's own autograd
+# function. gradients are instead all-reduced explicitly once the backward is done, coalesced into one buffer per dtype
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def broadcast_parameters(model, src = 0):
+    # every process starts from the parameters and buffers of the source process
+    for t in chain(model.parameters(), model.buffers()):
+        dist.broadcast(t.data, src)
+
+def all_reduce_gradients(model, active = True):
+    # averages gradients over the processes still training, and returns their number
+    # processes out of data keep calling with active = False, contributing zero gradients and stepping with the
+    # averaged ones, so every process takes the same optimizer steps until the number returned drops to zero
+    params = [p for p in model.parameters() if p.requires_grad]
+    grads = [p.grad.data if active and p.grad is not None else torch.zeros_like(p.data) for p in params]
+
+    num_active = torch.tensor([float(active)], device = params[0].device)
+    dist.all_reduce(num_active)
+    num_active = int(num_active.item())
+
+    if num_active == 0:
+        return 0
+
+    buckets = {}
+    for ind, grad in enumerate(grads):
+        buckets.setdefault(grad.dtype, []).append(ind)
+
+    for inds in buckets.values():
+        bucket = [grads[ind] for ind in inds]
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat)
+        flat /= num_active
+
+        for ind, grad in zip(inds, _unflatten_dense_tensors(flat, bucket)):
+            if params[ind].grad is None:
+                params[ind].grad = grad
+            else:
+                params[ind].grad.data.copy_(grad)
+
+    return num_active
+
+def all_reduce_sums(values, device):
+    # sums python numbers over the processes, such as the running totals of an evaluation sharded between them
+    if not is_distributed():
+        return list(values)
+
+    totals = torch.tensor([float(value) for value in values], dtype = torch.float64, device = device)
+    dist.all_reduce(totals)
+    return totals.tolist()
+
+def all_gather_tensor(t, device):
+    # the tensor of every process, in rank order and on the cpu, for tensors of the same shape on all of them
+    if not is_distributed():
+        return [t]
+
+    t = t.to(device)
+    gathered = [torch.empty_like(t) for _ in range(get_world_size())]
+    dist.all_gather(gathered, t)
+    return [g.cpu() for g in gathered]
+
+# spawns one process per device, or per cpu socket with gloo, on this machine
+# fn is called as fn(rank, world_size, *args) within an initialized process group
+
+def run_process(rank, fn, world_size, backend, args):
+    dist.init_process_group(backend, rank = rank, world_size = world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+def launch(fn, world_size, *args, backend = 'gloo', master_addr = '127.0.0.1', master_port = 29500):
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    mp.spawn(run_process, args = (fn, world_size, backend, args), nprocs = world_size, join = True)
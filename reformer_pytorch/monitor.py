@@ -0,0 +1,135 @@
+import torch
+from torch import nn
+from reformer_pytorch.reformer_pytorch import LSHAttention, LSHSelfAttention
+
+class BucketStats(object):
+    def __init__(self, n_hashes, bucket_size, max_load, device):
+        self.n_hashes = n_hashes
+        self.bucket_size = bucket_size
+        self.max_load = max_load
+        self.rows = 0
+        self.queries = 0
+        self.load_histogram = torch.zeros(n_hashes, max_load + 1, dtype=torch.long, device=device)
+        self.max_load_sum = torch.zeros(n_hashes, device=device)
+        self.max_mean_ratio_sum = torch.zeros(n_hashes, device=device)
+        self.spilled = torch.zeros(n_hashes, dtype=torch.long, device=device)
+
+    def update(self, buckets, n_buckets, bucket_size):
+        # buckets is (batch, n_hashes * seqlen), already offset so that each round has its own range of bucket ids
+        batch, n_hashes = buckets.shape[0], self.n_hashes
+        seqlen = buckets.shape[1] // n_hashes
+        total_buckets = n_hashes * n_buckets
+        device = buckets.device
+
+        row_offsets = torch.arange(batch, device=device)[:, None] * total_buckets
+        counts = torch.bincount((buckets + row_offsets).flatten(), minlength=batch * total_buckets).reshape(batch, total_buckets)
+
+        # the sorted sequence is split into bins of bucket_size, a bucket spills when its run crosses a bin boundary
+        end = counts.cumsum(dim=-1)
+        start = end - counts
+        spills = (counts > 0) & ((start // bucket_size) != ((end - 1) // bucket_size))
+
+        counts = counts.reshape(batch, n_hashes, n_buckets)
+        spills = spills.reshape(batch, n_hashes, n_buckets)
+
+        max_load = counts.max(dim=-1)[0].float()
+        self.max_load_sum += max_load.sum(dim=0)
+        self.max_mean_ratio_sum += (max_load / (seqlen / n_buckets)).sum(dim=0)
+        self.spilled += (counts * spills.long()).sum(dim=(0, 2))
+
+        round_offsets = torch.arange(n_hashes, device=device)[None, :, None] * (self.max_load + 1)
+        histogram_ids = counts.clamp(max=self.max_load) + round_offsets
+        self.load_histogram += torch.bincount(histogram_ids.flatten(), minlength=n_hashes * (self.max_load + 1)).reshape(n_hashes, -1)
+
+        self.rows += batch
+        self.queries += batch * seqlen
+
+    def report(self):
+        rows = max(self.rows, 1)
+        return {
+            'n_hashes': self.n_hashes,
+            'bucket_size': self.bucket_size,
+            'load_histogram': self.load_histogram.cpu().tolist(),
+            'max_load': (self.max_load_sum / rows).cpu().tolist(),
+            'max_mean_load_ratio': (self.max_mean_ratio_sum / rows).cpu().tolist(),
+            'spill_fraction': (self.spilled.float() / max(self.queries, 1)).cpu().tolist()
+        }
+
+class BucketMonitor(nn.Module):
+    def __init__(self, net, max_load = None):
+        super().__init__()
+        self.net = net
+        self.max_load = max_load
+        self.stats = {}
+        self.on = True
+        self.ejected = False
+        self.recording = False
+        self.layer = 0
+        self.hooks = []
+
+    def eject(self):
+        self.ejected = True
+        self.clear()
+        self.unwire()
+        return self.net
+
+    def wire(self):
+        self.unwire()
+        for module in self.net.modules():
+            if isinstance(module, LSHAttention):
+                # unregistered, so the monitor never becomes a submodule of the net it wraps
+                object.__setattr__(module, '_bucket_monitor', self)
+            if isinstance(module, LSHSelfAttention):
+                self.hooks.append(module.register_forward_pre_hook(self.next_layer))
+
+    def unwire(self):
+        for module in self.net.modules():
+            if isinstance(module, LSHAttention):
+                object.__setattr__(module, '_bucket_monitor', None)
+
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def turn_on(self):
+        self.on = True
+
+    def turn_off(self):
+        self.on = False
+
+    def clear(self):
+        self.stats = {}
+
+    def next_layer(self, module, inputs):
+        self.layer += 1
+
+    def update(self, module, buckets, n_buckets, n_hashes, bucket_size):
+        # layers are counted by calls to self attention, so layers sharing tied weights are still told apart
+        # and the recompute of reversible layers on the backward pass, after forward returns, is skipped
+        if not self.recording:
+            return
+
+        # hash rounds and bucket size can be set per call, each setting keeps its own running counts
+        key = (max(self.layer, 0), n_hashes, bucket_size)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = BucketStats(n_hashes, bucket_size, self.max_load if self.max_load is not None else 4 * bucket_size, buckets.device)
+
+        with torch.no_grad():
+            stats.update(buckets, n_buckets, bucket_size)
+
+    def report(self):
+        return {key: stats.report() for key, stats in sorted(self.stats.items())}
+
+    def forward(self, *args, **kwargs):
+        assert not self.ejected, 'BucketMonitor has already been ejected and disposed'
+        if self.on:
+            self.wire()
+
+        self.layer = -1
+        self.recording = self.on
+        out = self.net(*args, **kwargs)
+        self.recording = False
+
+        self.unwire()
+        return out
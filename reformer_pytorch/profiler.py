@@ -0,0 +1,170 @@
+import os
+import json
+import time
+from collections import OrderedDict
+import torch
+from torch import nn
+from revtorch import ReversibleBlock
+from reformer_pytorch.reformer_pytorch import LSHAttention, FullQKAttention, FeedForward
+
+PROFILED_MODULES = (LSHAttention, FullQKAttention, FeedForward)
+
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+class Phase(object):
+    def __init__(self, profiler, module, name):
+        self.profiler = profiler
+        self.module = module
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.synchronize()
+        self.memory = self.profiler.memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.synchronize()
+        end = time.perf_counter()
+        self.profiler.record(self.module, self.name, self.start, end, self.profiler.memory() - self.memory)
+        return False
+
+class Profiler(nn.Module):
+    def __init__(self, net, device = None):
+        super().__init__()
+        self.net = net
+        self.iter = 0
+        self.events = []
+        self.on = True
+        self.ejected = False
+        self.stage = 'backward'
+        self.origin = time.perf_counter()
+
+        params = list(net.parameters())
+        self.device = torch.device(device if device is not None else (params[0].device if len(params) > 0 else 'cpu'))
+
+        # layer index of each profiled module, tied weights will report under the last layer using them
+        self.layers = {}
+        blocks = [m for m in net.modules() if isinstance(m, ReversibleBlock)]
+        for ind, block in enumerate(blocks):
+            for module in block.modules():
+                if isinstance(module, PROFILED_MODULES):
+                    self.layers[id(module)] = ind
+
+        for module in net.modules():
+            if isinstance(module, PROFILED_MODULES) and id(module) not in self.layers:
+                self.layers[id(module)] = len(blocks) + len(self.layers)
+
+    def eject(self):
+        self.ejected = True
+        self.clear()
+        self.unwire()
+        return self.net
+
+    # attached with object.__setattr__, as nn.Module would otherwise register the profiler as a submodule of the
+    # modules it wraps, a cycle that state_dict, to and repr recurse on without end
+
+    def wire(self):
+        for module in self.net.modules():
+            if isinstance(module, PROFILED_MODULES):
+                object.__setattr__(module, '_profiler', self)
+
+    def unwire(self):
+        for module in self.net.modules():
+            if isinstance(module, PROFILED_MODULES):
+                object.__setattr__(module, '_profiler', None)
+
+    def turn_on(self):
+        self.on = True
+        self.wire()
+
+    def turn_off(self):
+        self.on = False
+        self.unwire()
+
+    def clear(self):
+        self.events = []
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def memory(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_allocated(self.device)
+        return resident_memory()
+
+    def phase(self, module, name):
+        return Phase(self, module, name)
+
+    def record(self, module, name, start, end, memory):
+        # reversible layers recompute their forward during the backward pass, after the wrapped forward has returned
+        self.events.append({
+            'iter': self.iter,
+            'layer': self.layers.get(id(module), -1),
+            'module': module.__class__.__name__,
+            'phase': name,
+            'stage': self.stage,
+            'start': start - self.origin,
+            'duration': end - start,
+            'memory': memory
+        })
+
+    def forward(self, *args, **kwargs):
+        assert not self.ejected, 'Profiler has already been ejected and disposed'
+        if self.on:
+            self.wire()
+
+        self.stage = 'forward'
+        out = self.net(*args, **kwargs)
+        self.stage = 'backward'
+
+        self.iter += 1
+        return out
+
+    def summary(self):
+        rows = OrderedDict()
+        for event in self.events:
+            key = (event['layer'], event['module'], event['phase'], event['stage'])
+            row = rows.setdefault(key, {'layer': key[0], 'module': key[1], 'phase': key[2], 'stage': key[3], 'calls': 0, 'total_ms': 0., 'memory_mb': 0.})
+            row['calls'] += 1
+            row['total_ms'] += event['duration'] * 1e3
+            row['memory_mb'] += event['memory'] / 2 ** 20
+
+        rows = list(rows.values())
+        for row in rows:
+            row['mean_ms'] = row['total_ms'] / row['calls']
+        return rows
+
+    def table(self):
+        header = f'{"layer":>5} {"module":<16} {"phase":<12} {"stage":<8} {"calls":>6} {"total ms":>10} {"mean ms":>9} {"memory mb":>10}'
+        lines = [header, '-' * len(header)]
+        for row in self.summary():
+            lines.append(f'{row["layer"]:>5} {row["module"]:<16} {row["phase"]:<12} {row["stage"]:<8} {row["calls"]:>6} {row["total_ms"]:>10.3f} {row["mean_ms"]:>9.3f} {row["memory_mb"]:>10.2f}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        # one track per layer, viewable in chrome://tracing or perfetto
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': layer, 'args': {'name': f'layer {layer}'}} for layer in sorted(set(self.layers.values()))]
+
+        for event in self.events:
+            trace.append({
+                'name': event['phase'],
+                'cat': f'{event["module"]},{event["stage"]}',
+                'ph': 'X',
+                'pid': 0,
+                'tid': event['layer'],
+                'ts': event['start'] * 1e6,
+                'dur': event['duration'] * 1e6,
+                'args': {'iter': event['iter'], 'stage': event['stage'], 'memory_mb': event['memory'] / 2 ** 20}
+            })
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
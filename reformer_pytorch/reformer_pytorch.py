@@ -3,8 +3,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
-from functools import partial
+from functools import partial, reduce
+from operator import mul
 from itertools import chain
+from contextlib import contextmanager
 from revtorch import ReversibleBlock, ReversibleSequence
 
 #constants
@@ -30,12 +32,52 @@ def process_inputs_chunk(fn, *args, chunks=1, dim=0):
     outputs = [fn(*input_pair) for input_pair in zip(*chunked_inputs)]
     return tuple(map(lambda x: torch.cat(x, dim=dim), zip(*outputs)))
 
+def expand_to_heads(t, heads, kv_len, pad_value):
+    # padded over appended memory and keys, repeated for each head merged into the batch
+    b, n = t.shape
+    if n < kv_len:
+        t = F.pad(t, (0, kv_len - n), 'constant', pad_value)
+    return t[:, None, :].expand(-1, heads, -1).reshape(b * heads, kv_len)
+
+def expand_input_mask(input_mask, heads, kv_len, device):
+    # bool and on device, with appended memory and keys visible
+    return expand_to_heads(input_mask.to(device).bool(), heads, kv_len, True)
+
+def expand_segment_ids(segment_ids, heads, kv_len, device):
+    # appended memory and keys get segment -1, visible to every segment
+    return expand_to_heads(segment_ids.to(device).long(), heads, kv_len, -1)
+
 def chunked_sum(tensor, chunks=1):
     *orig_size, last_dim = tensor.shape
     tensor = tensor.reshape(-1, last_dim)
     summed_tensors = [c.sum(dim=-1) for c in tensor.chunk(chunks, dim=0)]
     return torch.cat(summed_tensors, dim=0).reshape(orig_size)
 
+def top_p_filter(logits, top_p):
+    # keeps the most likely tokens until their probability reaches top_p, the rest get -inf
+    sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+
+    sorted_remove = cumulative_probs > top_p
+    sorted_remove[..., 1:] = sorted_remove[..., :-1].clone()
+    sorted_remove[..., 0] = False
+
+    remove = torch.zeros_like(sorted_remove).scatter(-1, sorted_indices, sorted_remove)
+    return logits.masked_fill(remove, float('-inf'))
+
+def causal_tiled_dots(q, k, scale, tiles = 4):
+    # scores of each bin's queries against the keys of the same bin, both (bins, bin, dim)
+    # tiles above the block diagonal are left unset for the caller to mask
+    bin_size = q.shape[-2]
+    tiles = next(n for n in (tiles, 2, 1) if bin_size % n == 0)
+    tile = bin_size // tiles
+
+    dots = q.new_empty(q.shape[:-1] + (bin_size,))
+    for ind in range(tiles):
+        rows, cols = slice(ind * tile, (ind + 1) * tile), (ind + 1) * tile
+        dots[:, rows, :cols] = torch.einsum('bie,bje->bij', q[:, rows], k[:, :cols]) * scale
+    return dots
+
 def cache_fn(f):
     cache = None
     def cached_fn(*args, **kwargs):
@@ -52,17 +94,71 @@ def default(val, default_val):
 def max_neg_value(tensor):
     return -torch.finfo(tensor.dtype).max
 
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_PHASE = NullPhase()
+
+def profile_phase(module, name):
+    profiler = module._profiler
+    return NULL_PHASE if profiler is None else profiler.phase(module, name)
+
 # helper classes
 
+class AbsolutePositionEmbedding(nn.Embedding):
+    def forward(self, seq_len, offset = 0):
+        assert offset + seq_len <= self.num_embeddings, f'positions up to {offset + seq_len} exceed the {self.num_embeddings} learned position embeddings'
+        return self.weight[None, offset:offset + seq_len]
+
 class FixedPositionEmbedding(nn.Module):
-    def __init__(self, dim):
+    def __init__(self, dim, max_cache_len = 8192):
         super().__init__()
         inv_freq = 1 / (10000 ** (torch.arange(0, dim, 2) / dim))
         self.register_buffer('inv_freq', inv_freq)
 
-    def forward(self, positions):
-        sinusoid_inp = torch.einsum("i,j->ij", positions.float(), self.inv_freq)
-        emb = torch.cat((sinusoid_inp.sin(), sinusoid_inp.cos()), dim=-1)
+        # sinusoid table, grown lazily to the largest length seen up to max_cache_len. kept out of the state dict
+        # positions past it, as reached when streaming with an offset, are computed for the requested window only
+        self.max_cache_len = max_cache_len
+        self.cached_emb = None
+
+    def build_emb(self, start, end):
+        positions = torch.arange(start, end, device=self.inv_freq.device).float()
+        sinusoid_inp = torch.einsum("i,j->ij", positions, self.inv_freq.float())
+        return torch.cat((sinusoid_inp.sin(), sinusoid_inp.cos()), dim=-1)
+
+    def forward(self, seq_len, offset = 0):
+        end = offset + seq_len
+        if end > self.max_cache_len:
+            return self.build_emb(offset, end)[None, :, :]
+
+        emb = self.cached_emb
+        if emb is None or emb.shape[0] < end or emb.device != self.inv_freq.device:
+            emb = self.cached_emb = self.build_emb(0, end)
+
+        return emb[None, offset:end]
+
+class AxialPositionEmbedding(nn.Module):
+    def __init__(self, dim, max_seq_len, axial_shape):
+        super().__init__()
+        assert reduce(mul, axial_shape, 1) >= max_seq_len, f'axial position shape {axial_shape} must cover the max sequence length {max_seq_len}'
+        self.axial_shape = tuple(axial_shape)
+        self.weights = nn.ParameterList([nn.Parameter(torch.zeros(axial_len, dim).normal_(0, 1)) for axial_len in axial_shape])
+
+        # position i maps to one index per axis, read as a mixed radix number with the last axis varying fastest
+        strides = [reduce(mul, axial_shape[ind + 1:], 1) for ind in range(len(axial_shape))]
+        self.strides = strides
+
+    def forward(self, seq_len, offset = 0):
+        device = self.weights[0].device
+        positions = torch.arange(offset, offset + seq_len, device=device)
+
+        emb = 0
+        for weight, axial_len, stride in zip(self.weights, self.axial_shape, self.strides):
+            emb = emb + weight[(positions // stride) % axial_len]
         return emb[None, :, :]
 
 class ScaleNorm(nn.Module):
@@ -102,11 +198,18 @@ class SettableArgs(nn.Module):
         self.kwargs = kwargs
         self.fn = fn
 
+        self.record_input = False
+        self.recorded_input = None
+
     def set_args(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
 
     def forward(self, x):
+        # reversible layers run forward without grad and recompute with grad on the backward pass,
+        # so only inputs seen in the first pass are recorded
+        if self.record_input and not torch.is_grad_enabled():
+            self.recorded_input = x.detach()
         return self.fn(x, *self.args, **self.kwargs)
 
 # LSH attention as described in https://openreview.net/pdf?id=rkgNKkHtvB
@@ -149,7 +252,23 @@ class LSHAttention(nn.Module):
         # will expend extra computation to return attention matrix
         self._return_attn = return_attn
 
-    def hash_vectors(self, n_buckets, vecs):
+        # set by the Profiler wrapper to time each phase
+        self._profiler = None
+
+        # set by the BucketMonitor wrapper to collect bucket load statistics
+        self._bucket_monitor = None
+
+        # strict upper triangular masks by bin size, for the static causal case
+        self._causal_masks = {}
+
+    def causal_mask(self, bin_size, device):
+        key = (bin_size, device)
+        if key not in self._causal_masks:
+            self._causal_masks[key] = torch.ones(bin_size, bin_size, device=device).triu(1).bool()
+        return self._causal_masks[key]
+
+    def hash_vectors(self, n_buckets, vecs, n_hashes = None):
+        n_hashes = default(n_hashes, self.n_hashes)
         batch_size = vecs.shape[0]
         device = vecs.device
 
@@ -163,7 +282,7 @@ class LSHAttention(nn.Module):
         rotations_shape = (
             batch_size if self._random_rotations_per_head else 1,
             vecs.shape[-1],
-            self.n_hashes if self._rehash_each_round else 1,
+            n_hashes if self._rehash_each_round else 1,
             rot_size // 2)
 
         random_rotations = torch.randn(rotations_shape, dtype=vecs.dtype, device=device).expand(batch_size, -1, -1, -1)
@@ -174,152 +293,232 @@ class LSHAttention(nn.Module):
         if self._rehash_each_round:
             rotated_vecs = torch.cat([rotated_vecs, -rotated_vecs], dim=-1)
             buckets = torch.argmax(rotated_vecs, dim=-1)
-            # buckets is now (self.n_hashes, seqlen). Next we add offsets so that
+            # buckets is now (n_hashes, seqlen). Next we add offsets so that
             # bucket numbers from different hashing rounds don't overlap.
-            offsets = torch.arange(self.n_hashes, device=device)
+            offsets = torch.arange(n_hashes, device=device)
             offsets = torch.reshape(offsets * n_buckets, (1, -1, 1))
             buckets = torch.reshape(buckets + offsets, (batch_size, -1,))
         else:
             rotated_vecs = torch.cat([rotated_vecs, -rotated_vecs], dim=-1)
-            # In this configuration, we map each item to the top self.n_hashes buckets
+            # In this configuration, we map each item to the top n_hashes buckets
             rotated_vecs = torch.squeeze(rotated_vecs, 0)
             bucket_range = torch.arange(rotated_vecs.shape[-1], device=device)
             bucket_range = torch.reshape(bucket_range, (1, -1))
             bucket_range = bucket_range.expand_as(rotated_vecs.shape)
 
             _, buckets = sort_key_val(rotated_vecs, bucket_range, dim=-1)
-            buckets = buckets[:, -self.n_hashes:]
+            buckets = buckets[:, -n_hashes:]
 
             h, *_ = buckets.shape 
             buckets = torch.reshape(buckets.permute((*_, h)), (-1,))
 
         return buckets
 
-    def forward(self, qk, v, query_len = None, input_mask = None):
+    def forward(self, qk, v, query_len = None, input_mask = None, segment_ids = None, n_hashes = None, bucket_size = None):
         batch_size, seqlen, dim = qk.shape
         query_len = default(query_len, seqlen)
         device = qk.device
 
-        n_buckets = seqlen // self.bucket_size
-
-        buckets = self.hash_vectors(n_buckets, qk)
-        # We use the same vector as both a query and a key.
-        assert int(buckets.shape[1]) == self.n_hashes * seqlen
-
-        ticker = torch.arange(self.n_hashes * seqlen, device=device).unsqueeze(0).expand_as(buckets)
-        buckets_and_t = seqlen * buckets + (ticker % seqlen)
-        buckets_and_t = buckets_and_t.detach()
-
-        # Hash-based sort ("s" at the start of variable names means "sorted")
-        sbuckets_and_t, sticker = sort_key_val(buckets_and_t, ticker, dim=-1)
-        _, undo_sort = sort_key_val(sticker, ticker, dim=-1)
-        del ticker
-
-        sbuckets_and_t = sbuckets_and_t.detach()
-        sticker = sticker.detach()
-        undo_sort = undo_sort.detach()
-
-        st = (sticker % seqlen)
-        sqk = batched_index_select(qk, st)
-        sv = batched_index_select(v, st)
-
-        # Split off a "bin" axis so that attention only occurs within chunks.
-        chunk_size = self.n_hashes * n_buckets
-        bq_t = bkv_t = torch.reshape(st, (batch_size, chunk_size, -1))
-        bqk = torch.reshape(sqk, (batch_size, chunk_size, -1, dim))
-        bv = torch.reshape(sv, (batch_size, chunk_size, -1, dim))
-
-        # Hashing operates on unit-length vectors. Unnormalized query vectors are
-        # fine because they effectively provide a learnable temperature for the
-        # attention softmax, but normalizing keys is needed so that similarity for
-        # the purposes of attention correctly corresponds to hash locality.
-        bq = bqk
-        bk = F.normalize(bqk, p=2, dim=-1).type(bq.type())
-
-        # Allow each chunk to attend within itself, and also one chunk back. Chunk
-        # boundaries might occur in the middle of a sequence of items from the
-        # same bucket, so this increases the chances of attending to relevant items.
-        def look_one_back(x):
-            x_extra = torch.cat([x[:, -1:, ...], x[:, :-1, ...]], dim=1)
-            return torch.cat([x, x_extra], dim=2)
-
-        bk = look_one_back(bk)
-        bv = look_one_back(bv)
-        bkv_t = look_one_back(bkv_t)
-
-        # Dot-product attention.
-        dots = torch.einsum('bhie,bhje->bhij', bq, bk) * (dim ** -0.5)
-        masked_value = max_neg_value(dots)
-
-        # Input mask for padding in variable lengthed sequences
-        if input_mask is not None:
-            input_mask = F.pad(input_mask, (0, seqlen - input_mask.shape[1]), 'constant', True)
-            mq = input_mask.gather(1, st).reshape((batch_size, chunk_size, -1))
-            mkv = look_one_back(mq)
-            mask = mq[:, :, :, None] * mkv[:, :, None, :]
-            dots.masked_fill_(~mask, masked_value)
-            del mask
-
-        # Causal masking
-        if self.causal:
-            mask = bq_t[:, :, :, None] < bkv_t[:, :, None, :].clamp(max=query_len - 1)
-            dots.masked_fill_(mask, masked_value)
-            del mask
-
-        # Mask out attention to self except when no other targets are available.
-        self_mask = bq_t[:, :, :, None] == bkv_t[:, :, None, :]
-        dots.masked_fill_(self_mask, TOKEN_SELF_ATTN_VALUE)
-        del self_mask
-
-        # Mask out attention to other hash buckets.
-        if not self._attend_across_buckets:
-            bq_buckets = bkv_buckets = torch.reshape(sbuckets_and_t // seqlen, (batch_size, chunk_size, -1))
-            bkv_buckets = look_one_back(bkv_buckets)
-            bucket_mask = bq_buckets[:, :, :, None] != bkv_buckets[:, :, None, :]
-            dots.masked_fill_(bucket_mask, masked_value)
-            del bucket_mask
-
-        # Don't double-count query-key pairs across multiple rounds of hashing.
-        # There are two possible strategies here. (1) The default is to count how
-        # many times a query-key pair is repeated, and to lower its log-prob
-        # correspondingly at each repetition. (2) When hard_k is set, the code
-        # instead masks all but the first occurence of each query-key pair.
-        if not self._allow_duplicate_attention:
-            locs1 = undo_sort // bq_t.shape[-1]
-            locs2 = (locs1 + 1) % chunk_size
+        # hash rounds and bucket size can be overridden per call, to trade quality for speed at inference
+        n_hashes = default(n_hashes, self.n_hashes)
+        bucket_size = default(bucket_size, self.bucket_size)
+        n_buckets = seqlen // bucket_size
+
+        with profile_phase(self, 'hashing'):
+            buckets = self.hash_vectors(n_buckets, qk, n_hashes = n_hashes)
+            # We use the same vector as both a query and a key.
+            assert int(buckets.shape[1]) == n_hashes * seqlen
+
+        if self._bucket_monitor is not None:
+            self._bucket_monitor.update(self, buckets, n_buckets, n_hashes, bucket_size)
+
+        with profile_phase(self, 'sort'):
+            ticker = torch.arange(n_hashes * seqlen, device=device).unsqueeze(0).expand_as(buckets)
+            buckets_and_t = seqlen * buckets + (ticker % seqlen)
+            buckets_and_t = buckets_and_t.detach()
+
+            # Hash-based sort ("s" at the start of variable names means "sorted")
+            sbuckets_and_t, sticker = sort_key_val(buckets_and_t, ticker, dim=-1)
+            _, undo_sort = sort_key_val(sticker, ticker, dim=-1)
+            del ticker
+
+            sbuckets_and_t = sbuckets_and_t.detach()
+            sticker = sticker.detach()
+            undo_sort = undo_sort.detach()
+
+        with profile_phase(self, 'gather'):
+            st = (sticker % seqlen)
+
+            # Split off a "bin" axis so that attention only occurs within chunks.
+            chunk_size = n_hashes * n_buckets
+            bin_size = st.shape[-1] // chunk_size
+
+            # Allow each chunk to attend within itself, and also one chunk back. Chunk
+            # boundaries might occur in the middle of a sequence of items from the
+            # same bucket, so this increases the chances of attending to relevant items.
+            # Each row is gathered with its last bin in front, and the bins of all rows flattened together, so the
+            # bins one back are a view offset by one bin rather than a copy. The bin in front of each following row
+            # is attended from the last bin of the row before, which is thrown away at the end.
+            def extend(x):
+                return torch.cat([x[:, -bin_size:], x], dim=1)
+
+            def split_bins(x):
+                return x.reshape(batch_size * (chunk_size + 1), bin_size, *x.shape[2:])
+
+            def look_one_back(x):
+                return x[1:], x[:-1]
+
+            def merge_bins(x):
+                x = torch.cat([x[:1], x], dim=0)
+                return x.reshape(batch_size, chunk_size + 1, *x.shape[1:])[:, 1:]
+
+            st_ext = extend(st)
+            bqk = split_bins(batched_index_select(qk, st_ext))
+            bv = split_bins(batched_index_select(v, st_ext))
+            bkv_t = split_bins(st_ext)
+            bq_t = bkv_t[1:]
+
+            # Hashing operates on unit-length vectors. Unnormalized query vectors are
+            # fine because they effectively provide a learnable temperature for the
+            # attention softmax, but normalizing keys is needed so that similarity for
+            # the purposes of attention correctly corresponds to hash locality.
+            bq = bqk[1:]
+            bk = F.normalize(bqk, p=2, dim=-1).type(bq.type())
+
+        # With causal masking and attention restricted to the query's own bucket, the causal mask is static.
+        # Within a bin, keys after the query in sorted order are either later in its bucket or in another
+        # bucket, and keys of the bin before are either earlier in its bucket or in another bucket, except for
+        # the wrapped around bin before the first bin of each row. The strict upper triangle of the current bin
+        # is masked, so those tiles are never computed.
+        static_causal = self.causal and not self._attend_across_buckets and query_len == seqlen
+
+        # Dot-product attention, as separate score blocks for the current bin and the bin before.
+        with profile_phase(self, 'dots'):
+            bk_cur, bk_prev = look_one_back(bk)
+            scale = dim ** -0.5
+            dots = [
+                causal_tiled_dots(bq, bk_cur, scale) if static_causal else torch.einsum('bie,bje->bij', bq, bk_cur) * scale,
+                torch.einsum('bie,bje->bij', bq, bk_prev) * scale
+            ]
+            masked_value = max_neg_value(dots[0])
+
+        with profile_phase(self, 'masking'):
+            bkv_ts = look_one_back(bkv_t)
+
+            # Padding, causal and bucket masks are folded into one boolean per score block, filled in a single pass.
+            # Padding and causal masks come from one comparison of per token codes, masking a query from a key when
+            # its code is below the key's. Padded queries get -2 and padded keys seqlen, masking them from everything.
+            # With causal masking codes are positions, except keys past the queries (memory and passed in keys) get
+            # -1 to be visible to all queries. Otherwise queries get 0 and keys -1.
+            masks = [None, None]
+            causal_codes = self.causal and not static_causal
+
+            if causal_codes or input_mask is not None:
+                if causal_codes:
+                    q_code = bkv_t
+                    k_code = bkv_t.masked_fill(bkv_t >= query_len, -1) if seqlen > query_len else bkv_t
+                else:
+                    q_code = torch.zeros_like(bkv_t)
+                    k_code = torch.full_like(bkv_t, -1)
+
+                # Input mask for padding in variable lengthed sequences
+                if input_mask is not None:
+                    if input_mask.shape[1] < seqlen:
+                        input_mask = F.pad(input_mask, (0, seqlen - input_mask.shape[1]), 'constant', True)
+                    mqkv = split_bins(input_mask.gather(1, st_ext))
+                    q_code = q_code.masked_fill(~mqkv, -2)
+                    k_code = k_code.masked_fill(~mqkv, seqlen)
+
+                masks = [q_code[1:, :, None] < kv_code[:, None, :] for kv_code in look_one_back(k_code)]
+
+            # Segment mask for documents packed into one row, keys of segment -1 are visible to all segments
+            if segment_ids is not None:
+                if segment_ids.shape[1] < seqlen:
+                    segment_ids = F.pad(segment_ids, (0, seqlen - segment_ids.shape[1]), 'constant', -1)
+                bkv_segments = split_bins(segment_ids.gather(1, st_ext))
+                bq_segments = bkv_segments[1:]
+                for ind, kv_segments in enumerate(look_one_back(bkv_segments)):
+                    segment_mask = (bq_segments[:, :, None] != kv_segments[:, None, :]) & (kv_segments[:, None, :] >= 0)
+                    masks[ind] = segment_mask if masks[ind] is None else masks[ind] | segment_mask
+
+            if static_causal:
+                causal_mask = self.causal_mask(bin_size, device)
+                masks[0] = causal_mask if masks[0] is None else masks[0] | causal_mask
+
+            # Mask out attention to other hash buckets.
             if not self._attend_across_buckets:
-                locs1 = buckets * chunk_size + locs1
-                locs2 = buckets * chunk_size + locs2
-            locs = torch.cat([
-                torch.reshape(locs1, (batch_size, self.n_hashes, seqlen)),
-                torch.reshape(locs2, (batch_size, self.n_hashes, seqlen)),
-            ], 1).permute((0, 2, 1))
-
-            slocs = batched_index_select(locs, st)
-            b_locs = torch.reshape(slocs, (batch_size, chunk_size, -1, 2 * self.n_hashes))
-
-            b_locs1 = b_locs[:, :, :, None, :self.n_hashes]
-
-            bq_locs = b_locs1.expand(b_locs.shape[:3] + (2, self.n_hashes))
-            bq_locs = torch.reshape(bq_locs, b_locs.shape)
-            bkv_locs = look_one_back(b_locs)
-
-            dup_counts = (bq_locs[:, :, :, None, :] == bkv_locs[:, :, None, :, :])
-            # for memory considerations, chunk summation of last dimension for counting duplicates
-            dup_counts = chunked_sum(dup_counts, chunks=(self.n_hashes * batch_size))
-            dup_counts = dup_counts.detach()
-            assert dup_counts.shape == dots.shape
-            dots = dots - torch.log(dup_counts + 1e-9)
-            del dup_counts
-
-        # Softmax.
-        dots_logsumexp = torch.logsumexp(dots, dim=-1, keepdim=True)
-        dots = torch.exp(dots - dots_logsumexp).type(dots.type())
-        dropped_dots = self.dropout(dots)
-
-        bo = torch.einsum('buij,buje->buie', dropped_dots, bv)
-        so = torch.reshape(bo, (batch_size, -1, dim))
-        slogits = torch.reshape(dots_logsumexp, (batch_size, -1,))
+                bkv_buckets = split_bins(extend(sbuckets_and_t // seqlen))
+                bq_buckets = bkv_buckets[1:]
+                for ind, kv_buckets in enumerate(look_one_back(bkv_buckets)):
+                    bucket_mask = bq_buckets[:, :, None] != kv_buckets[:, None, :]
+                    if masks[ind] is not None:
+                        bucket_mask |= masks[ind]
+                    masks[ind] = bucket_mask
+
+            # The bin before the first bin of each row wraps around to the row's last bin. With a single hash round
+            # that bin can hold later positions of the same bucket, so those blocks are still compared by position.
+            if static_causal:
+                first_bins = torch.arange(batch_size, device=device) * (chunk_size + 1)
+                masks[1][first_bins] |= bq_t[first_bins][:, :, None] < bkv_ts[1][first_bins][:, None, :]
+
+            for block, mask in zip(dots, masks):
+                if mask is not None:
+                    block.masked_fill_(mask, masked_value)
+            del masks
+
+            # Mask out attention to self except when no other targets are available.
+            # A token is in a bin once per round, so in the current bin it only attends to itself on the diagonal.
+            # In the bin before, it can only meet itself from another round, already masked as another bucket
+            # when attending within buckets.
+            dots[0].diagonal(dim1=-2, dim2=-1).fill_(TOKEN_SELF_ATTN_VALUE)
+            if self._attend_across_buckets:
+                self_mask = bq_t[:, :, None] == bkv_ts[1][:, None, :]
+                dots[1].masked_fill_(self_mask, TOKEN_SELF_ATTN_VALUE)
+                del self_mask
+
+            # Don't double-count query-key pairs across multiple rounds of hashing.
+            # There are two possible strategies here. (1) The default is to count how
+            # many times a query-key pair is repeated, and to lower its log-prob
+            # correspondingly at each repetition. (2) When hard_k is set, the code
+            # instead masks all but the first occurence of each query-key pair.
+            if not self._allow_duplicate_attention:
+                locs1 = undo_sort // bin_size
+                locs2 = (locs1 + 1) % chunk_size
+                if not self._attend_across_buckets:
+                    locs1 = buckets * chunk_size + locs1
+                    locs2 = buckets * chunk_size + locs2
+                locs = torch.cat([
+                    torch.reshape(locs1, (batch_size, n_hashes, seqlen)),
+                    torch.reshape(locs2, (batch_size, n_hashes, seqlen)),
+                ], 1).permute((0, 2, 1))
+
+                b_locs = split_bins(batched_index_select(locs, st_ext))
+
+                b_locs1 = b_locs[1:, :, None, :n_hashes]
+
+                bq_locs = b_locs1.expand(-1, -1, 2, -1)
+                bq_locs = torch.reshape(bq_locs, (-1, bin_size, 2 * n_hashes))
+
+                for ind, bkv_locs in enumerate(look_one_back(b_locs)):
+                    dup_counts = (bq_locs[:, :, None, :] == bkv_locs[:, None, :, :])
+                    # for memory considerations, chunk summation of last dimension for counting duplicates
+                    dup_counts = chunked_sum(dup_counts, chunks=(n_hashes * batch_size))
+                    dup_counts = dup_counts.detach()
+                    assert dup_counts.shape == dots[ind].shape
+                    dots[ind] = dots[ind] - torch.log(dup_counts + 1e-9)
+                    del dup_counts
+
+        # Softmax, normalized over both blocks.
+        with profile_phase(self, 'softmax'):
+            dots_logsumexp = torch.cat([torch.logsumexp(block, dim=-1, keepdim=True) for block in dots], dim=-1)
+            dots_logsumexp = torch.logsumexp(dots_logsumexp, dim=-1, keepdim=True)
+            dots = [torch.exp(block - dots_logsumexp).type(block.type()) for block in dots]
+
+        with profile_phase(self, 'attend'):
+            bv_cur, bv_prev = look_one_back(bv)
+            bo = torch.einsum('bij,bje->bie', self.dropout(dots[0]), bv_cur) + torch.einsum('bij,bje->bie', self.dropout(dots[1]), bv_prev)
+            so = torch.reshape(merge_bins(bo), (batch_size, -1, dim))
+            slogits = torch.reshape(merge_bins(dots_logsumexp), (batch_size, -1,))
 
         class UnsortLogits(Function):
             @staticmethod
@@ -336,27 +535,32 @@ class LSHAttention(nn.Module):
                 _, slogits_grad = sort_key_val(buckets_and_t, grad_y, dim=-1)
                 return so_grad, slogits_grad
 
-        o, logits = UnsortLogits.apply(so, slogits)
-        o = torch.reshape(o, (batch_size, self.n_hashes, seqlen, dim))
-        logits = torch.reshape(logits, (batch_size, self.n_hashes, seqlen, 1))
+        with profile_phase(self, 'unsort'):
+            o, logits = UnsortLogits.apply(so, slogits)
+            o = torch.reshape(o, (batch_size, n_hashes, seqlen, dim))
+            logits = torch.reshape(logits, (batch_size, n_hashes, seqlen, 1))
 
-        if query_len != seqlen:
-            query_slice = (slice(None), slice(None), slice(0, query_len))
-            o, logits = o[query_slice], logits[query_slice]
+            if query_len != seqlen:
+                query_slice = (slice(None), slice(None), slice(0, query_len))
+                o, logits = o[query_slice], logits[query_slice]
 
-        probs = torch.exp(logits - torch.logsumexp(logits, dim=1, keepdim=True))
-        out = torch.sum(o * probs, dim=1)
+            probs = torch.exp(logits - torch.logsumexp(logits, dim=1, keepdim=True))
+            out = torch.sum(o * probs, dim=1)
 
         attn = torch.empty(0, device=device)
 
         # return unsorted attention weights
         if self._return_attn:
+            bq_t = merge_bins(bq_t)
+            bkv_t = torch.cat([merge_bins(kv_t) for kv_t in bkv_ts], dim=-1)
+            dots = torch.cat([merge_bins(block) for block in dots], dim=-1)
+
             attn_unsort = ((bq_t * seqlen)[:, :, :, None] + bkv_t[:, :, None, :])
-            attn_unsort = attn_unsort.view(batch_size * self.n_hashes, -1).long()
-            unsorted_dots = torch.zeros(batch_size * self.n_hashes, seqlen * seqlen, device=device)
-            unsorted_dots.scatter_add_(1, attn_unsort, dots.view_as(attn_unsort))
+            attn_unsort = attn_unsort.reshape(batch_size * n_hashes, -1).long()
+            unsorted_dots = torch.zeros(batch_size * n_hashes, seqlen * seqlen, device=device)
+            unsorted_dots.scatter_add_(1, attn_unsort, dots.reshape_as(attn_unsort))
             del attn_unsort
-            unsorted_dots = unsorted_dots.reshape(batch_size, self.n_hashes, seqlen, seqlen)
+            unsorted_dots = unsorted_dots.reshape(batch_size, n_hashes, seqlen, seqlen)
             attn = torch.sum(unsorted_dots[:, :, 0:query_len, :] * probs, dim=1)
 
         # return output, attention matrix, and bucket distribution
@@ -368,34 +572,47 @@ class FullQKAttention(nn.Module):
     def __init__(self, causal = False):
         super().__init__()
         self.causal = causal
+        self._profiler = None
 
-    def forward(self, qk, v, query_len = None, input_mask = None):
+    def forward(self, qk, v, query_len = None, input_mask = None, segment_ids = None):
         b, seq_len, dim = qk.shape
         query_len = default(query_len, seq_len)
         t = query_len
 
-        q = qk[:, 0:query_len]
-        qk = F.normalize(qk, 2, dim=-1).type(q.type())
+        with profile_phase(self, 'dots'):
+            q = qk[:, 0:query_len]
+            qk = F.normalize(qk, 2, dim=-1).type(q.type())
+
+            dot = torch.einsum('bie,bje->bij', q, qk) * (dim ** -0.5)
+
+        with profile_phase(self, 'masking'):
+            # qk attention requires tokens not attend to self
+            i = torch.arange(t)
+            dot[:, i, i] = TOKEN_SELF_ATTN_VALUE
+            masked_value = max_neg_value(dot)
 
-        dot = torch.einsum('bie,bje->bij', q, qk) * (dim ** -0.5)
+            # Input mask for padding in variable lengthed sequences, broadcast over the queries
+            if input_mask is not None:
+                if input_mask.shape[1] < seq_len:
+                    input_mask = F.pad(input_mask, (0, seq_len - input_mask.shape[1]), 'constant', True)
+                dot.masked_fill_(~input_mask[:, None, :], masked_value)
 
-        # qk attention requires tokens not attend to self
-        i = torch.arange(t)
-        dot[:, i, i] = TOKEN_SELF_ATTN_VALUE
-        masked_value = max_neg_value(dot)
+            # Segment mask for documents packed into one row
+            if segment_ids is not None:
+                if segment_ids.shape[1] < seq_len:
+                    segment_ids = F.pad(segment_ids, (0, seq_len - segment_ids.shape[1]), 'constant', -1)
+                k_segments = segment_ids[:, None, :]
+                dot.masked_fill_((segment_ids[:, :t, None] != k_segments) & (k_segments >= 0), masked_value)
 
-        # Input mask for padding in variable lengthed sequences
-        if input_mask is not None:
-            mask = input_mask[:, :, None] * input_mask[:, None, :]
-            mask = F.pad(mask, (0, seq_len - mask.shape[-1]), 'constant', True)
-            dot.masked_fill_(~mask, masked_value)
+            if self.causal:
+                i, j = torch.triu_indices(t, t, 1)
+                dot[:, i, j] = masked_value
 
-        if self.causal:
-            i, j = torch.triu_indices(t, t, 1)
-            dot[:, i, j] = masked_value
+        with profile_phase(self, 'softmax'):
+            dot = dot.softmax(dim=-1)
 
-        dot = dot.softmax(dim=-1)
-        out = torch.einsum('bij,bje->bie', dot, v)
+        with profile_phase(self, 'attend'):
+            out = torch.einsum('bij,bje->bie', dot, v)
 
         return out, dot, torch.empty(0)
 
@@ -426,9 +643,10 @@ class LSHSelfAttention(nn.Module):
 
         self.callback = None
 
-    def forward(self, x, keys = None, input_mask = None):
+    def forward(self, x, keys = None, input_mask = None, segment_ids = None, n_hashes = None, bucket_size = None):
         device = x.device
         b, t, e, h, m = *x.shape, self.heads, self.num_mem_kv
+        bucket_size = default(bucket_size, self.bucket_size)
 
         mem = self.mem_kv.expand(b, m, e)
         keys = default(keys, torch.empty(b, 0, e, dtype=mem.dtype, device=device))
@@ -437,7 +655,7 @@ class LSHSelfAttention(nn.Module):
         use_full_attn = self.use_full_attn or kv_len <= self.full_attn_thres
 
         if not use_full_attn:
-            assert not use_full_attn and (kv_len % self.bucket_size == 0), f'Sequence length needs to be divisible by target bucket size - {self.bucket_size}'
+            assert not use_full_attn and (kv_len % bucket_size == 0), f'Sequence length needs to be divisible by target bucket size - {bucket_size}'
 
         x = torch.cat((x, mem, keys), dim=1)
         qk = self.toqk(x)
@@ -452,9 +670,20 @@ class LSHSelfAttention(nn.Module):
         qk = merge_heads(qk)
         v = merge_heads(v)
 
-        attn_fn = self.lsh_attn if not use_full_attn else self.full_attn
-        partial_attn_fn = partial(attn_fn, query_len = t, input_mask = input_mask)
-        out, attn, buckets = process_inputs_chunk(partial_attn_fn, qk, v, chunks=self.attn_chunks)
+        # masks normalized by Reformer already match the merged heads, so they are chunked along with them
+        if input_mask is not None and input_mask.shape != (b * h, kv_len):
+            input_mask = expand_input_mask(input_mask, h, kv_len, device)
+
+        if segment_ids is not None and segment_ids.shape != (b * h, kv_len):
+            segment_ids = expand_segment_ids(segment_ids, h, kv_len, device)
+
+        attn_fn = self.full_attn if use_full_attn else partial(self.lsh_attn, n_hashes = n_hashes, bucket_size = bucket_size)
+        masks = {name: mask for name, mask in (('input_mask', input_mask), ('segment_ids', segment_ids)) if mask is not None}
+
+        def attend(qk, v, *mask_chunks):
+            return attn_fn(qk, v, query_len = t, **dict(zip(masks.keys(), mask_chunks)))
+
+        out, attn, buckets = process_inputs_chunk(attend, qk, v, *masks.values(), chunks=self.attn_chunks)
         out = split_heads(out).view(b, t, e)
 
         if self.callback is not None:
@@ -462,6 +691,27 @@ class LSHSelfAttention(nn.Module):
 
         return self.to_out(out)
 
+# set hash rounds and bucket size of every LSH attention layer within the block, restoring them on exit
+# the backward pass of reversible layers reruns attention, so it should also happen within the block
+
+@contextmanager
+def lsh_settings(net, n_hashes = None, bucket_size = None):
+    modules = [m for m in net.modules() if isinstance(m, (LSHAttention, LSHSelfAttention))]
+    saved = [(m, m.bucket_size, getattr(m, 'n_hashes', None)) for m in modules]
+
+    for m in modules:
+        m.bucket_size = default(bucket_size, m.bucket_size)
+        if isinstance(m, LSHAttention):
+            m.n_hashes = default(n_hashes, m.n_hashes)
+
+    try:
+        yield net
+    finally:
+        for m, saved_bucket_size, saved_n_hashes in saved:
+            m.bucket_size = saved_bucket_size
+            if isinstance(m, LSHAttention):
+                m.n_hashes = saved_n_hashes
+
 # feed forward
 
 class GELU(nn.Module):
@@ -476,18 +726,112 @@ class FeedForward(nn.Module):
             GELU(),
             nn.Linear(dim * mult, dim))
 
+        self._profiler = None
+
     def forward(self, x):
-        return self.net(x)
+        with profile_phase(self, 'feedforward'):
+            return self.net(x)
+
+# fused output projection and cross entropy
+# logits are computed one vocab chunk at a time with an online logsumexp, and recomputed on the backward pass,
+# so the full (tokens x vocab) logits are never held in memory
+
+class ChunkedCrossEntropy(Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, labels, chunks):
+        lse = None
+        for w, b in zip(weight.chunk(chunks), bias.chunk(chunks)):
+            logits = torch.addmm(b, x, w.t()).float()
+            chunk_lse = torch.logsumexp(logits, dim=-1)
+            lse = chunk_lse if lse is None else torch.logsumexp(torch.stack((lse, chunk_lse)), dim=0)
+
+        target_logits = (x * weight[labels]).sum(dim=-1).float() + bias[labels].float()
+
+        ctx.chunks = chunks
+        ctx.save_for_backward(x, weight, bias, labels, lse)
+        return (lse - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weight, bias, labels, lse = ctx.saved_tensors
+        grad_scale = grad_output / max(x.shape[0], 1)
+
+        grad_x = torch.zeros_like(x)
+        grad_weights, grad_biases = [], []
+        offset = 0
+
+        for w, b in zip(weight.chunk(ctx.chunks), bias.chunk(ctx.chunks)):
+            chunk_size = w.shape[0]
+            logits = torch.addmm(b, x, w.t()).float()
+            grad_logits = torch.exp(logits - lse[:, None])
+
+            # subtract the one hot targets that fall within this chunk
+            rows = torch.nonzero((labels >= offset) & (labels < offset + chunk_size)).squeeze(-1)
+            grad_logits[rows, labels[rows] - offset] -= 1
+            grad_logits = (grad_logits * grad_scale).type(x.dtype)
+
+            grad_x += grad_logits @ w
+            grad_weights.append(grad_logits.t() @ x)
+            grad_biases.append(grad_logits.sum(dim=0))
+            offset += chunk_size
+
+        return grad_x, torch.cat(grad_weights), torch.cat(grad_biases), None, None
+
+def chunked_cross_entropy(x, to_logits, labels, chunks = 1, ignore_index = -100):
+    mask = labels != ignore_index
+    x, labels = x[mask], labels[mask]
+    return ChunkedCrossEntropy.apply(x, to_logits.weight, to_logits.bias, labels, chunks)
+
+# adaptive softmax, frequent tokens are scored by the head and rarer ones in clusters with reduced projection dimensions
+# tokens ids are expected to be sorted by frequency
+
+class AdaptiveLogSoftmax(nn.AdaptiveLogSoftmaxWithLoss):
+    def forward(self, x):
+        *shape, dim = x.shape
+        return self.log_prob(x.reshape(-1, dim)).reshape(*shape, -1)
+
+    def loss(self, x, labels, ignore_index = -100):
+        mask = labels != ignore_index
+        return super().forward(x[mask], labels[mask]).loss
+
+    def sample(self, x, temperature = 1.):
+        # samples the flat distribution at the given temperature, p(w) ** (1 / temperature), as a cluster then a word
+        # within it. a cluster is picked with the mass its words keep at that temperature, which is its head
+        # probability alone only at temperature 1, so otherwise every cluster is scored for every row
+        head_scores = self.head(x).log_softmax(dim=-1) / temperature
+        tail_scores = [None] * len(self.tail)
+
+        if temperature != 1.:
+            for ind, tail in enumerate(self.tail):
+                tail_scores[ind] = tail(x).log_softmax(dim=-1) / temperature
+
+            cluster_mass = torch.stack([scores.logsumexp(dim=-1) for scores in tail_scores], dim=-1)
+            head_scores = torch.cat((head_scores[:, :self.shortlist_size], head_scores[:, self.shortlist_size:] + cluster_mass), dim=-1)
+
+        samples = torch.multinomial(head_scores.softmax(dim=-1), 1).squeeze(-1)
+
+        # samples landing on a cluster are resampled within that cluster only
+        for ind, tail in enumerate(self.tail):
+            rows = torch.nonzero(samples == self.shortlist_size + ind).squeeze(-1)
+            if rows.numel() == 0:
+                continue
+
+            cluster_scores = tail_scores[ind][rows] if tail_scores[ind] is not None else tail(x[rows])
+            cluster_samples = torch.multinomial(cluster_scores.softmax(dim=-1), 1).squeeze(-1)
+            samples[rows] = self.cutoffs[ind] + cluster_samples
+
+        return samples
 
 # reformer lm
 
 class Reformer(nn.Module):
-    def __init__(self, dim, depth, max_seq_len, heads = 8, bucket_size = 64, n_hashes = 8, ff_chunks = 100, attn_chunks = None, causal = False, weight_tie = False, lsh_dropout = 0., lsh_attend_across_buckets = True, lsh_allow_duplicate_attention = True, random_rotations_per_head = False, twin_attention = False, use_scale_norm = False, use_full_attn = False, full_attn_thres = None, num_mem_kv = 0):
+    def __init__(self, dim, depth, max_seq_len, heads = 8, bucket_size = 64, n_hashes = 8, ff_chunks = 100, attn_chunks = None, causal = False, weight_tie = False, lsh_dropout = 0., lsh_attend_across_buckets = True, lsh_allow_duplicate_attention = True, random_rotations_per_head = False, twin_attention = False, use_scale_norm = False, use_full_attn = False, full_attn_thres = None, num_mem_kv = 0, mem_len = 0):
         super().__init__()
         self.dim = dim
         self.depth = depth
+        self.mem_len = mem_len
 
-        get_attn = lambda: SettableArgs(LSHSelfAttention(dim, heads, bucket_size, n_hashes, causal = causal, dropout = lsh_dropout, attn_chunks = attn_chunks, allow_duplicate_attention = lsh_allow_duplicate_attention, attend_across_buckets = lsh_attend_across_buckets, random_rotations_per_head = random_rotations_per_head, num_mem_kv = num_mem_kv, use_full_attn = use_full_attn, full_attn_thres = full_attn_thres))
+        get_attn = lambda: LSHSelfAttention(dim, heads, bucket_size, n_hashes, causal = causal, dropout = lsh_dropout, attn_chunks = attn_chunks, allow_duplicate_attention = lsh_allow_duplicate_attention, attend_across_buckets = lsh_attend_across_buckets, random_rotations_per_head = random_rotations_per_head, num_mem_kv = num_mem_kv, use_full_attn = use_full_attn, full_attn_thres = full_attn_thres)
         get_ff = lambda: FeedForward(dim)
 
         if weight_tie:
@@ -497,9 +841,10 @@ class Reformer(nn.Module):
         blocks = []
         norm_type = ScaleNorm if use_scale_norm else nn.LayerNorm
 
+        # arguments are set per layer, so tied attention is wrapped separately for each layer
         for _ in range(depth):
-            attn = get_attn()
-            parallel_net = get_attn() if twin_attention else get_ff()
+            attn = SettableArgs(get_attn())
+            parallel_net = SettableArgs(get_attn()) if twin_attention else get_ff()
 
             f = WithNorm(norm_type, dim, attn)
             g = WithNorm(norm_type, dim, parallel_net)
@@ -512,33 +857,130 @@ class Reformer(nn.Module):
         self.layers = ReversibleSequence(nn.ModuleList(blocks), eagerly_discard_variables = False)
         self.layer_modules = list(chain(*[[m.f_block.fn, m.g_block.fn] for m in blocks]))
 
+        self.attn_modules = [m for m in self.layer_modules if isinstance(m, SettableArgs)]
+
     def set_reversible_args(self, *args, **kwargs):
-        for module in self.layer_modules:
-            if isinstance(module, SettableArgs):
-                module.set_args(*args, **kwargs)
+        for module in self.attn_modules:
+            module.set_args(*args, **kwargs)
+
+    def set_recurrent_mems(self, mems, keys = None, **kwargs):
+        assert len(mems) == len(self.attn_modules), f'expected {len(self.attn_modules)} memories, one for each attention layer'
+        for module, mem in zip(self.attn_modules, mems):
+            mem_keys = mem if keys is None else torch.cat((mem, keys), dim=1)
+            module.set_args(keys = mem_keys, **kwargs)
+
+    def forward(self, x, mems = None, return_mems = False, **kwargs):
+        # normalize the input mask and segment ids once for all layers, rather than in every layer and head chunk
+        input_mask, segment_ids = kwargs.get('input_mask'), kwargs.get('segment_ids')
+        if input_mask is not None or segment_ids is not None:
+            attn = self.attn_modules[0].fn
+            keys = kwargs.get('keys')
+            kv_len = x.shape[1] + attn.num_mem_kv + (keys.shape[1] if keys is not None else 0) + (mems[0].shape[1] if mems is not None else 0)
+            if input_mask is not None:
+                kwargs['input_mask'] = expand_input_mask(input_mask, attn.heads, kv_len, x.device)
+            if segment_ids is not None:
+                kwargs['segment_ids'] = expand_segment_ids(segment_ids, attn.heads, kv_len, x.device)
 
-    def forward(self, x, **kwargs):
         x = torch.cat([x, x], dim = -1)
-        self.set_reversible_args(**kwargs)
+
+        if mems is not None:
+            self.set_recurrent_mems(mems, **kwargs)
+        else:
+            self.set_reversible_args(**kwargs)
+
+        if return_mems:
+            assert self.mem_len > 0, 'mem_len must be set to a positive length to return memories'
+            for module in self.attn_modules:
+                module.record_input = True
+
         x = self.layers(x)
-        return torch.stack(x.chunk(2, dim=-1)).sum(dim=0)
+        out = torch.stack(x.chunk(2, dim=-1)).sum(dim=0)
+
+        if not return_mems:
+            return out
+
+        new_mems = []
+        for ind, module in enumerate(self.attn_modules):
+            hiddens = module.recorded_input
+            if mems is not None:
+                hiddens = torch.cat((mems[ind], hiddens), dim=1)
+            new_mems.append(hiddens[:, -self.mem_len:].detach())
+
+            module.record_input = False
+            module.recorded_input = None
+
+        return out, new_mems
 
 class ReformerLM(nn.Module):
-    def __init__(self, num_tokens, dim, depth, max_seq_len, heads = 8, bucket_size = 64, n_hashes = 8, ff_chunks = 100, attn_chunks = None, causal = False, weight_tie = False, lsh_dropout = 0., random_rotations_per_head = False, twin_attention = False, use_scale_norm = False, use_full_attn = False, full_attn_thres = None, num_mem_kv = 0, emb_dim = None, return_embeddings = False, fixed_position_emb = False):
+    def __init__(self, num_tokens, dim, depth, max_seq_len, heads = 8, bucket_size = 64, n_hashes = 8, ff_chunks = 100, attn_chunks = None, causal = False, weight_tie = False, lsh_dropout = 0., lsh_attend_across_buckets = True, lsh_allow_duplicate_attention = True, random_rotations_per_head = False, twin_attention = False, use_scale_norm = False, use_full_attn = False, full_attn_thres = None, num_mem_kv = 0, mem_len = 0, emb_dim = None, return_embeddings = False, fixed_position_emb = False, axial_position_emb = False, axial_position_shape = None, vocab_chunks = 8, adaptive_softmax_cutoffs = None, adaptive_softmax_div = 4.):
         super().__init__()
+        assert not (fixed_position_emb and axial_position_emb), 'only one of fixed or axial position embeddings can be used'
         emb_dim = default(emb_dim, dim)
         self.token_emb = nn.Embedding(num_tokens, emb_dim)
-        self.pos_emb = FixedPositionEmbedding(emb_dim) if fixed_position_emb else nn.Embedding(max_seq_len, emb_dim)
+
+        if fixed_position_emb:
+            self.pos_emb = FixedPositionEmbedding(emb_dim, max_cache_len = max_seq_len)
+        elif axial_position_emb:
+            axial_position_shape = default(axial_position_shape, (math.ceil(max_seq_len / bucket_size), bucket_size))
+            self.pos_emb = AxialPositionEmbedding(emb_dim, max_seq_len, axial_position_shape)
+        else:
+            self.pos_emb = AbsolutePositionEmbedding(max_seq_len, emb_dim)
         self.to_model_dim = identity if emb_dim == dim else nn.Linear(emb_dim, dim)
 
-        self.reformer = Reformer(dim, depth, max_seq_len, heads = heads, bucket_size = bucket_size, n_hashes = n_hashes, ff_chunks = ff_chunks, attn_chunks = attn_chunks, causal = causal, weight_tie = weight_tie, lsh_dropout = lsh_dropout, random_rotations_per_head = random_rotations_per_head, twin_attention = twin_attention, use_scale_norm = use_scale_norm, use_full_attn = use_full_attn, full_attn_thres = full_attn_thres, num_mem_kv = num_mem_kv)
-        self.to_logits = identity if return_embeddings else nn.Linear(dim, num_tokens)
+        self.reformer = Reformer(dim, depth, max_seq_len, heads = heads, bucket_size = bucket_size, n_hashes = n_hashes, ff_chunks = ff_chunks, attn_chunks = attn_chunks, causal = causal, weight_tie = weight_tie, lsh_dropout = lsh_dropout, lsh_attend_across_buckets = lsh_attend_across_buckets, lsh_allow_duplicate_attention = lsh_allow_duplicate_attention, random_rotations_per_head = random_rotations_per_head, twin_attention = twin_attention, use_scale_norm = use_scale_norm, use_full_attn = use_full_attn, full_attn_thres = full_attn_thres, num_mem_kv = num_mem_kv, mem_len = mem_len)
+        self.vocab_chunks = vocab_chunks
 
-    def forward(self, x, **kwargs):
-        t = torch.arange(x.shape[1], device=x.device)
+        if return_embeddings:
+            self.to_logits = identity
+        elif adaptive_softmax_cutoffs is not None:
+            self.to_logits = AdaptiveLogSoftmax(dim, num_tokens, cutoffs = adaptive_softmax_cutoffs, div_value = adaptive_softmax_div)
+        else:
+            self.to_logits = nn.Linear(dim, num_tokens)
+
+    def encode(self, x, pos_offset = 0, position_ids = None, **kwargs):
+        t = x.shape[1]
         x = self.token_emb(x)
-        x = x + self.pos_emb(t).type(x.type())
+
+        pos_emb = self.pos_emb(t, offset = pos_offset)
+        if position_ids is not None:
+            # packed documents restart their positions, each below the row length
+            pos_emb = pos_emb[0][position_ids]
+
+        x = x + pos_emb.type(x.type())
 
         x = self.to_model_dim(x)
-        x = self.reformer(x, **kwargs)
-        return self.to_logits(x)
+        return self.reformer(x, **kwargs)
+
+    def forward(self, x, labels = None, ignore_index = -100, pos_offset = 0, return_mems = False, **kwargs):
+        x = self.encode(x, pos_offset = pos_offset, return_mems = return_mems, **kwargs)
+
+        if return_mems:
+            x, mems = x
+
+        if labels is None:
+            out = self.to_logits(x)
+        elif isinstance(self.to_logits, AdaptiveLogSoftmax):
+            out = self.to_logits.loss(x, labels, ignore_index = ignore_index)
+        else:
+            assert self.to_logits is not identity, 'a loss cannot be computed when returning embeddings'
+            out = chunked_cross_entropy(x, self.to_logits, labels, chunks = self.vocab_chunks, ignore_index = ignore_index)
+
+        return (out, mems) if return_mems else out
+
+    @torch.no_grad()
+    def sample_next(self, x, temperature = 1., top_p = None, **kwargs):
+        assert self.to_logits is not identity, 'cannot sample when returning embeddings'
+        assert not kwargs.get('return_mems', False), 'sample_next returns sampled tokens only, call encode to get memories'
+        kwargs.pop('return_mems', None)
+        x = self.encode(x, **kwargs)[:, -1]
+
+        if isinstance(self.to_logits, AdaptiveLogSoftmax):
+            assert top_p is None, 'top_p filtering needs the full distribution, which the adaptive softmax does not compute when sampling'
+            return self.to_logits.sample(x, temperature)
+
+        logits = self.to_logits(x) / temperature
+        if top_p is not None:
+            logits = top_p_filter(logits, top_p)
+
+        probs = logits.softmax(dim=-1)
+        return torch.multinomial(probs, 1).squeeze(-1)
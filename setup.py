@@ -2,7 +2,7 @@ from setuptools import setup, find_packages
 
 setup(
   name = 'reformer_pytorch',
-  packages = find_packages(exclude=['examples']),
+  packages = find_packages(exclude=['examples', 'benchmarks', 'benchmarks.*']),
   version = '0.12.6',
   license='MIT',
   description = 'Reformer, the Efficient Transformer, Pytorch',